@@ -4,14 +4,13 @@ A few test setups of the world
 
 from simcubes.world import cSimWorld
 from simcubes.cubes import *
-from simcubes.en import Orientation
+from simcubes.en import Orientation, CubeTypes
 
 def generate_grass_plain(N=10, M=10, H=1):
     '''
-    :return: A single chunk, plain of grass
+    :return: A plain of grass
     '''
     TheWorld = cSimWorld()
-    TheWorld.set_active_chunk(1)
 
     counter = 1
     for x in range(N):
@@ -24,6 +23,25 @@ def generate_grass_plain(N=10, M=10, H=1):
                 TheWorld.add_block(bl)
     return TheWorld
 
+def generate_grass_over_bedrock(N=16, M=16, H=4):
+    '''
+    :return: A plain of grass on top of H-1 layers of bedrock (passive blocks)
+    '''
+    TheWorld = cSimWorld()
+
+    counter = 1
+    for x in range(N):
+        for y in range(M):
+            for z in range(H - 1):
+                TheWorld.add_passive_block(CubeTypes.blBedRock, x, y, z, gid=counter)
+                counter += 1
+            bl = cGrass()
+            bl.set_coords(x, y, H - 1)
+            bl.set_gid(counter)
+            counter += 1
+            TheWorld.add_block(bl)
+    return TheWorld
+
 def generate_simple_conveyor_system():
     '''
     :return: Hand-tuned system with a box and a conveyor
@@ -55,10 +73,7 @@ def generate_simple_conveyor_system():
     box2.set_orientation(Orientation.North)
     TheWorld.add_block(box2)
 
-    box1.connect()
-    box2.connect()
-    conv1.connect()
-    conv2.connect()
+    TheWorld.connect_all_blocks()
 
     return TheWorld
 
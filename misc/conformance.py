@@ -0,0 +1,219 @@
+'''
+Differential conformance suite for scheduler backends. Runs the same worlds
+under every backend from simcubes.queues.QUEUES (with and without the timing
+wheel, with and without apply_next_tick budget) and checks that the traces of
+applied events are identical. Also checks that the batched events
+(cEvent.process_batch) are applied in batches, with the same trace as one
+by one.
+
+Register a new queue with simcubes.queues.register_queue and run:
+    python -m misc.conformance
+'''
+
+import logging
+
+from simcubes.simcore import cSimEnvironment
+from simcubes.queues import QUEUES, cSchedulerBackend, make_backend, key_to_tick, key_to_priority, SEQ_MASK
+from simcubes.behaviours.basebehaviour import iter_threads_in_holders
+from simcubes.behaviours.storage import cBehSpawn, cBehItemPullPush, cBehItemStorage
+from simcubes.behaviours.eco import cBloomTimer
+
+logger = logging.getLogger(__name__)
+
+
+# Scenarios: each one starts it's threads in the given environment
+
+def scenario_farm_to_boxes(env):
+    '''
+    farm -> conveyor -> conveyor -> box 1 -> conveyor -> box 2, without cubes.
+    The items keep flowing for the whole run.
+    '''
+    farm = cBehSpawn("FARM")
+    conv1 = cBehItemPullPush("CONV 1")
+    conv2 = cBehItemPullPush("CONV 2")
+    box1 = cBehItemStorage("BOX 1")
+    conv3 = cBehItemPullPush("CONV 3")
+    box2 = cBehItemStorage("BOX 2")
+
+    farm.connect_to(conv1, puller=True)
+    conv1.connect_to(farm, source=True)
+
+    conv1.connect_to(conv2, sink=True)
+    conv2.connect_to(conv1, source=True)
+
+    conv2.connect_to(box1, sink=True)
+    box1.connect_to(conv2, pusher=True)
+
+    box1.connect_to(conv3, puller=True)
+    conv3.connect_to(box1, source=True)
+
+    conv3.connect_to(box2, sink=True)
+    box2.connect_to(conv3, pusher=True)
+
+    env.start_threads([farm, conv1, conv2, box1, conv3, box2])
+
+
+def scenario_grass_plain(env):
+    from levelgenerator.plain import generate_grass_plain
+    level = generate_grass_plain(10, 10, 1)
+    env.start_threads(iter_threads_in_holders(level.iter_over_blocks()))
+
+
+def scenario_conveyor_system(env):
+    from levelgenerator.plain import generate_simple_conveyor_system
+    level = generate_simple_conveyor_system()
+    # fill the first box, so that the conveyors have something to move
+    for bl in level.iter_over_blocks():
+        if bl.gid == 100:
+            for beh in bl.iter_behaviours():
+                beh.quantity = 20
+    env.start_threads(iter_threads_in_holders(level.iter_over_blocks()))
+
+
+SCENARIOS = {
+    'farm_to_boxes': scenario_farm_to_boxes,
+    'grass_plain': scenario_grass_plain,
+    'conveyor_system': scenario_conveyor_system,
+}
+
+
+class cTracingBackend(cSchedulerBackend):
+    '''
+    Passes everything to another backend and remembers the entries it pops,
+    so that the time of an applied event is known.
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.popped = []  # (key, event) in the order of the pops
+
+    def push(self, key, ev):
+        self.backend.push(key, ev)
+
+    def pop_due(self, until_key):
+        entry = self.backend.pop_due(until_key)
+        if entry is not None:
+            self.popped += [entry]
+        return entry
+
+    def peek(self):
+        return self.backend.peek()
+
+    def cancel(self, key, ev):
+        self.backend.cancel(key, ev)
+
+    def size(self):
+        return self.backend.size()
+
+
+def record_trace(scenario, backend, use_wheel=True, max_events=None, until=20, tick_seconds=0.1):
+    '''
+    :param scenario: a function from SCENARIOS
+    :param backend: a name from QUEUES
+    :param use_wheel: see cSimSchedule
+    :param max_events: budget for each apply_next_tick call
+    :param until: simulate until this time
+    :param tick_seconds: game engine tick
+    :return: a list of (tick, priority, event class name, thread number,
+            sequence number) of the applied events. Threads are numbered in
+            the start order.
+    '''
+    tracing = cTracingBackend(make_backend(backend, use_wheel))
+    env = cSimEnvironment(tracing)
+    scenario(env)
+    thread_num = {thr: i for i, thr in enumerate(env.threads)}
+    sch = env.get_the_schedule()
+    trace = []
+    n_ticks = int(round(until / tick_seconds))
+    i = 1
+    while i <= n_ticks:
+        popped = tracing.popped
+        j = 0
+        for ev in sch.apply_next_tick(i * tick_seconds, max_events=max_events):
+            # the events are applied in the order of the pops, the cancelled
+            # ones are popped, but skipped. A shared event object may be
+            # applied several times, so it's matched by the position.
+            while popped[j][1] is not ev:
+                j += 1
+            key = popped[j][0]
+            j += 1
+            trace += [(key_to_tick(key), key_to_priority(key), ev.__class__.__name__,
+                       thread_num[ev.beh], key & SEQ_MASK)]
+        tracing.popped = []
+        if not sch.is_behind():
+            i += 1
+    return trace
+
+
+def check_conformance(until=20):
+    '''
+    :return: a list of strings, one for each mismatch. Empty if all
+            the backends agree.
+    '''
+    problems = []
+    for sc_name, scenario in SCENARIOS.items():
+        reference = record_trace(scenario, 'heap', use_wheel=False, until=until)
+        for backend in QUEUES:
+            for use_wheel in (False, True):
+                for max_events in (None, 7):
+                    trace = record_trace(scenario, backend, use_wheel, max_events, until)
+                    if trace != reference:
+                        problems += ["{}: backend {} (wheel {}, max_events {}) differs from the heap: {}".format(
+                            sc_name, backend, use_wheel, max_events, first_difference(reference, trace))]
+        logger.info("{}: {} events checked".format(sc_name, len(reference)))
+    return problems
+
+
+def check_batches(until=20):
+    '''
+    Run the grass plain with the blooming timers applied in batches and
+    one by one (process_batch switched off).
+    :return: a list of strings, one for each problem. Empty if the traces
+            are the same and the batches were there.
+    '''
+    problems = []
+    own_process_batch = cBloomTimer.__dict__['process_batch']
+    batch_sizes = []
+
+    def recording_process_batch(cls, timers):
+        batch_sizes.append(len(timers))
+        own_process_batch.__func__(cls, timers)
+
+    try:
+        cBloomTimer.process_batch = None
+        reference = record_trace(scenario_grass_plain, 'heap', use_wheel=False, until=until)
+        cBloomTimer.process_batch = classmethod(recording_process_batch)
+        for max_events in (None, 7):
+            del batch_sizes[:]
+            trace = record_trace(scenario_grass_plain, 'heap', False, max_events, until)
+            if trace != reference:
+                problems += ["batches (max_events {}) differ from one by one: {}".format(
+                    max_events, first_difference(reference, trace))]
+            if not batch_sizes or max(batch_sizes) < 2:
+                problems += ["no batches of the blooming timers (max_events {})".format(max_events)]
+            elif max_events is not None and max(batch_sizes) > max_events:
+                problems += ["a batch of {} events is over max_events {}".format(max(batch_sizes), max_events)]
+            logger.info("{} batches of {} events at most (max_events {})".format(
+                len(batch_sizes), max(batch_sizes, default=0), max_events))
+    finally:
+        cBloomTimer.process_batch = own_process_batch
+    return problems
+
+
+def first_difference(trace_a, trace_b):
+    for i, (a, b) in enumerate(zip(trace_a, trace_b)):
+        if a != b:
+            return "event {}: {} != {}".format(i, a, b)
+    return "length {} != {}".format(len(trace_a), len(trace_b))
+
+
+if __name__ == "__main__":
+    from misc import lg
+    lg.config_logging(whitelist=[__name__])
+
+    problems = check_conformance() + check_batches()
+    for p in problems:
+        logger.error(p)
+    if problems:
+        raise SystemExit(1)
+    logger.info("All the backends agree, the batches are the same as one by one")
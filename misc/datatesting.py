@@ -4,7 +4,7 @@ These classes help to log data during simulation. Very handy for testing.
 
 import pandas as pd
 
-from simcubes.simcore import cAsyncThread, cEvent
+from simcubes.simcore import cAsyncThread
 
 
 class cSimPeriodicObserver(cAsyncThread):
@@ -12,6 +12,8 @@ class cSimPeriodicObserver(cAsyncThread):
     A separate async thread that logs something specific.
     '''
 
+    periodic = True
+
     def __init__(self, target, sim_results, period=1):
         super().__init__()
         self.period = period
@@ -25,7 +27,7 @@ class cSimPeriodicObserver(cAsyncThread):
     def run(self):
         while True:
             self.observe_data()
-            yield cEvent(self, self.period)
+            yield self.period
 
     def observe_data(self):
         ts_name = "abstract"
@@ -6,7 +6,7 @@ import time
 import logging
 logger = logging.getLogger(__name__)
 
-def realtime_batch_simulation_cycle(env, seconds, tick_seconds=1, factor = 10, dolog=True):
+def realtime_batch_simulation_cycle(env, seconds, tick_seconds=1, factor = 10, dolog=True, max_ms=None):
     '''
     Starts realtime simulation of a given environment
     :param env: cSimEnvironment, a storage for schedule and an
@@ -16,6 +16,8 @@ def realtime_batch_simulation_cycle(env, seconds, tick_seconds=1, factor = 10, d
     :param factor: multiply game time for this number to get:
             factor * gametime = 1 real second. The smaller the
             factor, the faster is the 'game'.
+    :param max_ms: (optional) real time budget of each tick, see
+            cSimSchedule.apply_next_tick
     '''
     game_time = 0
     t = 0
@@ -27,11 +29,12 @@ def realtime_batch_simulation_cycle(env, seconds, tick_seconds=1, factor = 10, d
         game_time += tick_seconds/factor
         time.sleep(tick_seconds)
         t+= tick_seconds
-        events_happend = sch.apply_next_tick(game_time)
+        events_happend = sch.apply_next_tick(game_time, max_ms=max_ms)
         events_count = str(len(events_happend))
         real_dt = str(time.monotonic() - start_time)
         if dolog:
-            logger.info('game time is ' + str(game_time) + ', real tick is ' + real_dt + ',  events happened: ' + events_count)
+            logger.info('game time is ' + str(game_time) + ', real tick is ' + real_dt + ',  events happened: ' +
+                        events_count + ', lag: ' + str(sch.get_lag()))
 
 def one_time_simulation(env, until):
     '''
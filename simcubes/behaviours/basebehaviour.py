@@ -1,10 +1,66 @@
 
 from simcubes.simcore import cAsyncThread
+from simcubes.behaviours import network
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+class cEmptyDict(dict):
+    '''
+    The empty dict (or ordered set) shared by all the behaviours and holders
+    that have nothing in it yet. Most of them never do (grass isn't connected
+    to anything), so they don't carry dicts of their own. It can't be
+    changed: the owner puts a new dict instead before the first insert.
+    '''
+
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The shared empty dict can't be changed")
+
+    __setitem__ = __delitem__ = setdefault = update = pop = popitem = clear = _read_only
+
+    def __reduce__(self):
+        return '_EMPTY'  # unpickled as the same shared instance
+
+
+_EMPTY = cEmptyDict()
+
+# The dormancy informs go along the chains of clients, which may be as long
+# as the world is, so they are spread with a stack instead of recursion.
+# (client, service type, activation) entries, the next one on the top.
+_informs = []
+_spreading = [False]  # True while _inform_clients drains _informs
+
+
+def _inform_clients(provider, service_type, activation):
+    '''
+    Call get_informed_about_activation (or deactivation) of the clients
+    of provider, and of their clients if they change their activity, in
+    the same depth first order as the nested calls would.
+    :param service_type: inform only the clients of this type, None for all
+    :param activation: True for activation, False for deactivation
+    '''
+    informs = [(beh, ser_type, activation) for beh, ser_type in provider.clients
+               if service_type is None or ser_type == service_type]
+    informs.reverse()
+    _informs.extend(informs)
+    if _spreading[0]:
+        return  # a call up the stack is draining them
+    _spreading[0] = True
+    try:
+        while _informs:
+            beh, ser_type, activation = _informs.pop()
+            if activation:
+                beh.get_informed_about_activation(ser_type)
+            else:
+                beh.get_informed_about_deactivation(ser_type)
+    finally:
+        _spreading[0] = False
+        del _informs[:]
+
+
 def iter_threads_in_holders(holders):
     '''
     Each cube have behaviours. In order to run them, we need to
@@ -31,6 +87,13 @@ class cSimulBehaviour(cAsyncThread):
     it becomes inactive (and becomes active when it's possible).
     '''
 
+    __slots__ = ('parent', 'connected', 'providers', 'clients', 'dormant',
+                 'net', 'net_links')
+
+    # Service types (as in connect_to_provider) this behaviour can't
+    # operate without, see go_dormant
+    needed_services = ()
+
     def __init__(self, parent):
         '''
         :param parent: an object from the simulation (a block, a bunch of blocks).
@@ -38,28 +101,177 @@ class cSimulBehaviour(cAsyncThread):
         '''
         super().__init__()
         self.parent = parent
-        self.connected = []
+        self.connected = _EMPTY  # an ordered set, behaviour -> None
+        network.init_network(self)  # see get_network
+        self.providers = _EMPTY  # service type -> ordered set of behaviours providing it to this one
+        self.clients = _EMPTY  # ordered set of (behaviour, service type) this one provides to
+        self.dormant = False  # see go_dormant
 
     def __repr__(self):
         return "[behaviour of {}][{}]".format(self.parent, super().__repr__())
 
+    def set_environment(self, env):
+        super().set_environment(env)
+        self.chunk_id = getattr(self.parent, 'chunk_id', None)
+
+    def get_service_types(self):
+        '''
+        :return: a list of en.ServiceTypes, the holder registers this
+                behaviour for each of them. Internal behaviours have none.
+        '''
+        return []
+
     def connect_to(self, other_behaviour):
         if not(other_behaviour in self.connected):
-            self.connected += [other_behaviour]
+            if self.connected is _EMPTY:
+                self.connected = {}
+            self.connected[other_behaviour] = None
+            network.link(self, other_behaviour)
+
+    def get_connection_flags(self, other_behaviour):
+        '''
+        :return: a dict with the keyword arguments of connect_to to connect
+                to other_behaviour the same way again (the roles, like
+                source or sink)
+        '''
+        return {}
+
+    def connect_to_client(self, other_behaviour, service_type):
+        '''
+        Called from cBehaviourHolder.behavioural_connect_to: this behaviour
+        provides service_type to other_behaviour. Override to tell the roles
+        apart, default realisation just connects.
+        :param other_behaviour: a client behaviour
+        :param service_type: en.ServiceTypes
+        '''
+        self.connect_to(other_behaviour)
+
+    def connect_to_provider(self, other_behaviour, service_type):
+        '''
+        The opposite of connect_to_client: other_behaviour provides
+        service_type to this behaviour.
+        :param other_behaviour: a provider behaviour
+        :param service_type: en.ServiceTypes
+        '''
+        self.connect_to(other_behaviour)
+        self.add_provider(other_behaviour, service_type)
 
     def disconnect_from(self, other_behaviour):
         '''
-        This does not happen frequently, so it's ok to do some look ups here
         :param other_behaviour: disconnect from this behaviour
         '''
-        try:
-            i = self.connected.index(other_behaviour)
-            self.connected.pop(i)
-        except ValueError:
+        if not(other_behaviour in self.connected):
             logger.warning("An attempt to disconnect unrelated behaviour")
+            return
+        del self.connected[other_behaviour]
+        network.unlink(self, other_behaviour)
+        self.remove_provider(other_behaviour)
+        other_behaviour.remove_provider(self)
+
+    # Networks of connected behaviours, see behaviours.network
+
+    def get_network(self):
+        '''
+        :return: network id (see network.get_network), the same for all the
+                behaviours connected directly or through the others
+        '''
+        return network.get_network(self)
+
+    def get_network_size(self):
+        return network.get_network_size(self)
+
+    def get_network_members(self):
+        '''
+        :return: an ordered set of behaviours (behaviour -> None), don't modify it
+        '''
+        return network.get_network_members(self)
+
+    def is_in_same_network(self, other_behaviour):
+        return network.get_network(self) is network.get_network(other_behaviour)
+
+    # Dormancy. A behaviour that can't operate without it's providers of
+    # needed_services falls asleep (no events in the schedule) when all the
+    # providers of one of these types are inactive. The providers inform
+    # their clients when they become inactive (snooze) and active again
+    # (wake), so the dormancy goes down the chain and back.
+
+    def add_provider(self, other_behaviour, service_type):
+        '''
+        other_behaviour provides service_type to this behaviour, see
+        connect_to_provider.
+        '''
+        if self.providers is _EMPTY:
+            self.providers = {}
+        providers = self.providers.setdefault(service_type, {})
+        if not(other_behaviour in providers):
+            providers[other_behaviour] = None
+            if other_behaviour.clients is _EMPTY:
+                other_behaviour.clients = {}
+            other_behaviour.clients[(self, service_type)] = None
+            if self.dormant and other_behaviour.is_active():
+                self.get_informed_about_activation(service_type)
+
+    def remove_provider(self, other_behaviour):
+        for service_type, providers in self.providers.items():
+            if other_behaviour in providers:
+                del providers[other_behaviour]
+                del other_behaviour.clients[(self, service_type)]
 
     def is_active(self):
-        return not self.snoozed
+        return not(self.snoozed or self.dormant)
+
+    def can_go_dormant(self):
+        '''
+        Override to keep the behaviour awake when it has some work to do
+        without the providers.
+        :return: False if the thread isn't running or it's in the middle of
+                it's own event (the event is being applied).
+        '''
+        return self.is_running() and (self.snoozed or self.pending_event is not None)
+
+    def go_dormant(self):
+        '''
+        Cancel the scheduled event (it's kept for leave_dormancy) and
+        let the clients know.
+        '''
+        self.dormant = True
+        if self.pending_event is not None:
+            self.dormant_event = self.pending_event
+            self.cancel()
+        logger.info("[t={}][{} is dormant]".format(self.get_time(), self))
+        self.inform_connected_about_deactivation()
+
+    def leave_dormancy(self):
+        '''
+        Schedule the event cancelled by go_dormant again. A snoozed thread
+        stays snoozed, it's own wait queue would wake it.
+        '''
+        self.dormant = False
+        ev = self.dormant_event
+        if ev is not None:
+            self.dormant_event = None
+            self.do_schedule(ev)
+        logger.info("[t={}][{} is not dormant]".format(self.get_time(), self))
+        if self.is_active():
+            self.inform_connected_about_activation()
+
+    def snooze(self):
+        super().snooze()
+        if self.clients and not self.is_active():
+            self.inform_connected_about_deactivation()
+
+    def wake(self):
+        if not self.snoozed:
+            return
+        self.dormant = False  # the condition it waited for is true, so it's not idle
+        super().wake()
+        if self.clients:
+            self.inform_connected_about_activation()
+
+    def stop(self):
+        super().stop()
+        self.dormant = False
+        self.dormant_event = None
 
     def get_poked(self):
         """
@@ -69,7 +281,6 @@ class cSimulBehaviour(cAsyncThread):
         """
         self.wake()
 
-    # to be deleted
     def check_activity_of_connections(self, service_type):
         '''
         Checks whether there is an active behaviour in the connection type
@@ -77,70 +288,54 @@ class cSimulBehaviour(cAsyncThread):
         to suspend all the activity.
         :return: True if there is a single active connection. False otherwise.
         '''
-        for _ in filter(lambda beh: beh.is_active(), self.connected[service_type]):
-            return True
+        for beh in self.providers.get(service_type, ()):
+            if beh.is_active():
+                return True
+        return False
 
-    # to be deleted
     def inform_connected_about_activation(self, service_type=None):
         '''
         When this behaviour starts to activate, it should inform all the
         clients about this fact so that they can decide whether to activate
         as well. Since the behaviour shouldn't take guesses who are the
         clients, we should inform everyone or at least some of them (by type).
-        :param connection_type: (optional) inform only these types
+        :param service_type: (optional) inform only the clients of this type
         '''
-        if service_type is None:
-            for ser_type, beh in self.connected.items():
-                beh.get_informed_about_activation(ser_type)
-        else:
-            for beh in self.connected[service_type]:
-                beh.get_informed_about_activation(service_type)
+        _inform_clients(self, service_type, True)
 
-    # to be deleted
     def inform_connected_about_deactivation(self, service_type=None):
         '''
         The opposite of inform_connected_about_activation
-        :param connection_type: (optional) inform only these types
+        :param service_type: (optional) inform only the clients of this type
         '''
-        if service_type is None:
-            for ser_type, beh in self.connected.items():
-                beh.get_informed_about_deactivation(ser_type)
-        else:
-            for beh in self.connected[service_type]:
-                beh.get_informed_about_deactivation(service_type)
+        _inform_clients(self, service_type, False)
 
-    # to be deleted
     def get_informed_about_activation(self, service_type):
         '''
-        Implement this to optimise the simulation. If this behaviour
-        needs this service type to be active in order to operate
-        and there is no more connections of this type, it should
-        suspend all the activity.
-
-        In get_informed_about_deactivation we should stop the simulation,
-        in get_informed_about_activation we should resume the simulation.
+        A provider of service_type became active. If this behaviour
+        is dormant because of it, it resumes the simulation.
 
         :param service_type: this service type wants to inform you
                 about activation. This is an external to this instance
                 service type (if this is a conveyor, this would be "item
                 provider").
         '''
-        pass
+        if self.dormant and service_type in self.needed_services:
+            self.leave_dormancy()
 
-    # to be deleted
     def get_informed_about_deactivation(self, service_type):
         '''
-        Implement this to optimise the simulation. You should deactivate
-        the simulation 'service' if you rely on this service type and
-        there is no more active providers.
-        This is the opposite of get_informed_about_activation.
+        The opposite of get_informed_about_activation: if this behaviour
+        relies on service_type and there is no more active providers,
+        it goes dormant.
 
         :param service_type: this service type wants to inform you
-                about activation. This is an external to this instance
-                service type (if this is a conveyor, this would be "item
-                provider").
+                about deactivation, see get_informed_about_activation.
         '''
-        pass
+        if self.dormant or not(service_type in self.needed_services):
+            return
+        if self.can_go_dormant() and not self.check_activity_of_connections(service_type):
+            self.go_dormant()
 
 
 class cBehaviourHolder:
@@ -154,12 +349,11 @@ class cBehaviourHolder:
     '''
 
     def __init__(self):
-        self.unique_behaviours = []
-        self.behaviours = {}  # by service type, with duplicated references
+        self.unique_behaviours = _EMPTY  # an ordered set, behaviour -> None
+        self.behaviours = _EMPTY  # by service type (ordered sets as well), with duplicated references
 
     def iter_behaviours(self):
-        for beh in self.unique_behaviours:
-            yield beh
+        yield from self.unique_behaviours
 
     def register_behaviour(self, behaviour, service_type = 0):
         '''
@@ -171,30 +365,42 @@ class cBehaviourHolder:
                 would be automatically connected to another cube.
                 0 is for internal (not exposed) behaviours.
         '''
-        # add to the plain list (may be multiple calls for different
+        # add to the plain set (may be multiple calls for different
         # service types).
-        if not(behaviour in self.unique_behaviours):
-            self.unique_behaviours += [behaviour]
+        if self.unique_behaviours is _EMPTY:
+            self.unique_behaviours = {}
+            self.behaviours = {}
+        self.unique_behaviours[behaviour] = None
         # register as a service
-        if not(service_type in self.behaviours):
-            self.behaviours[service_type] = []
-        if not(behaviour in self.behaviours[service_type]):
-            self.behaviours[service_type] += [behaviour]
+        services = self.behaviours.get(service_type)
+        if services is None:
+            services = self.behaviours[service_type] = {}
+        if not(behaviour in services):
+            services[behaviour] = None
         else:
             # duplicates in one service type are not expected
             logger.error('Attempt to add a duplicating behaviour for one service type!')
             raise BaseException('Attempt to add a duplicating behaviour for one service type')
 
+    def unregister_behaviour(self, behaviour):
+        '''
+        The opposite of register_behaviour, for all the service types.
+        '''
+        del self.unique_behaviours[behaviour]
+        for services in self.behaviours.values():
+            services.pop(behaviour, None)
+
     def handler_to_service_type(self, service_type):
         '''
-        Use this to get the list of services by the service_type
+        Use this to get the behaviours by the service_type
 
         :param service_type: en.ServiceTypes
-        :return: a reference to the corresponding list
+        :return: a reference to the corresponding ordered set (a dict with
+                the behaviours as keys), iterate over it, don't modify it
         '''
-        if service_type in self.behaviours:
+        try:
             return self.behaviours[service_type]
-        else:
+        except KeyError:
             logger.error('Attempt to get a non-existing service type!')
             raise BaseException('Attempt to get a non-existing service type')
 
@@ -202,10 +408,11 @@ class cBehaviourHolder:
         '''
         The main entry point for behaviour connection of one behaviour holder with another.
         For example, this is called when cubes find a match with service layers.
+        This holder is the provider of the service, other_holder is the client.
 
         Override this call in order to change or improve connection routine!
 
-        :param other_holder: the other behaviour holder.
+        :param other_holder: the other behaviour holder (the client).
         :param inner_service_type: service type from this entity
         :param external_service_type: service type of other entity
         '''
@@ -219,7 +426,8 @@ class cBehaviourHolder:
         Connect to another behaviour holder (a block or a chunk usually).
         Shall take all the behaviours from other_holder with external_service_type
         and connect them with all the behaviours from this entity with inner_service_type.
-        Usually this is a 1-to-1 connection.
+        Usually this is a 1-to-1 connection. This entity provides the service,
+        other_holder is the client.
 
         Each concrete realisation should decide for it's own whether it
         wants to connect to another block or not.
@@ -235,5 +443,5 @@ class cBehaviourHolder:
                 # beh_external - a conveyor behaviour from another block
                 # inner_service_type - "item provider"
                 # external_service_type - "item puller"
-                beh_internal.connect_to(beh_external, inner_service_type)
-                beh_external.connect_to(beh_internal, external_service_type)
+                beh_internal.connect_to_client(beh_external, inner_service_type)
+                beh_external.connect_to_provider(beh_internal, external_service_type)
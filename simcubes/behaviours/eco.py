@@ -4,25 +4,56 @@ Environmental threads: blooming, growing, pollution e.t.c.
 
 import logging
 
+from simcubes.simcore import cStateMachine, cTimer
 from simcubes.behaviours.basebehaviour import cSimulBehaviour
-from simcubes.simcore import cEvent
 
 logger = logging.getLogger(__name__)
 
 
-class cBehBlooming(cSimulBehaviour):
+class cBloomTimer(cTimer):
+    '''
+    The timeouts of the blooming threads. A plain plain of grass has all
+    of them at the same moment, so they are applied in batches: stepping a
+    blooming thread only changes it's state and schedules the next timeout
+    (never a zero one), so the batch may be popped at once.
+    '''
+
+    __slots__ = ()
+
+    @classmethod
+    def process_batch(cls, timers):
+        for timer in timers:
+            beh = timer.beh
+            beh.pending_handle = None
+            beh.pending_event = None
+            beh.step()
+
+
+class cBehBlooming(cStateMachine, cSimulBehaviour):
     '''
     Periodically blooming.
     '''
 
+    __slots__ = ()
+
+    periodic = True
+
     def __init__(self, parent):
         super().__init__(parent)
-        self.is_active = True
-        self.is_blooming = False  # ?make this a state
-
-    def run(self):
-        while self.is_active:
-            self.is_blooming = True
-            yield cEvent(self, 0.1)  # a timeout
-            self.is_blooming = False
-            yield cEvent(self, 0.2)
\ No newline at end of file
+        self.timer = cBloomTimer(self)
+
+    WITHERED = 0
+    BLOOMING = 1
+    initial_state = WITHERED
+
+    @property
+    def is_blooming(self):
+        return self.state == self.BLOOMING
+
+    def bloom(self):
+        return 0.1  # a timeout
+
+    def wither(self):
+        return 0.2
+
+    transitions = ((bloom, BLOOMING), (wither, WITHERED))
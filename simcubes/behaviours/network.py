@@ -0,0 +1,148 @@
+'''
+Networks of connected behaviours (a conveyor line with it's boxes, a pipe
+system...). A network is a connected component of the graph where the
+behaviours are nodes and the connections (connect_to in any direction)
+are edges.
+
+The index is kept right on the behaviours:
+    net - the cNetwork the behaviour is in, it's the network id;
+    net_links - thread_id -> [other behaviour, number of connections],
+            the edges of the graph.
+Both are None until the first link: most behaviours (grass) are never
+connected, they are networks of their own without any allocations.
+
+Connecting merges two networks (the members of the smaller one move to
+the larger one). Disconnecting searches from both ends of the removed edge
+in turns: if the searches meet, the network is whole, if one of them runs
+out first, the part it has seen is split off. So both cost about the size
+of the smaller part. cSimulBehaviour calls link and unlink from connect_to
+and disconnect_from.
+'''
+
+
+class cNetwork:
+
+    __slots__ = ('members',)
+
+    def __init__(self, members):
+        '''
+        :param members: an ordered set of behaviours, behaviour -> None
+        '''
+        self.members = members
+
+
+def init_network(beh):
+    '''
+    Every behaviour is a network of it's own at the start.
+    '''
+    beh.net = None
+    beh.net_links = None
+
+
+def link(a, b):
+    '''
+    a got connected to b (or b to a).
+    '''
+    for beh in (a, b):
+        if beh.net is None:
+            beh.net = cNetwork({beh: None})
+            beh.net_links = {}
+    entry = a.net_links.get(b.thread_id)
+    if entry is None:
+        a.net_links[b.thread_id] = [b, 1]
+        b.net_links[a.thread_id] = [a, 1]
+    else:
+        entry[1] += 1
+        b.net_links[a.thread_id][1] += 1
+    _merge(a.net, b.net)
+
+
+def unlink(a, b):
+    '''
+    a got disconnected from b (or b from a).
+    '''
+    if a.net_links is None:
+        return
+    entry = a.net_links.get(b.thread_id)
+    if entry is None:
+        return
+    entry[1] -= 1
+    b.net_links[a.thread_id][1] -= 1
+    if entry[1] > 0:
+        return  # still connected the other way
+    del a.net_links[b.thread_id]
+    del b.net_links[a.thread_id]
+    _split(a, b)
+
+
+def get_network(beh):
+    '''
+    :return: the network id (a cNetwork, or the behaviour itself if it was
+            never connected). Two behaviours are in one network if the ids
+            are the same.
+    '''
+    if beh.net is None:
+        return beh
+    return beh.net
+
+
+def get_network_members(beh):
+    '''
+    :return: the behaviours of the network (an ordered set, behaviour -> None),
+            don't modify it
+    '''
+    if beh.net is None:
+        return {beh: None}
+    return beh.net.members
+
+
+def get_network_size(beh):
+    if beh.net is None:
+        return 1
+    return len(beh.net.members)
+
+
+def _merge(net_a, net_b):
+    if net_a is net_b:
+        return
+    if len(net_a.members) < len(net_b.members):
+        net_a, net_b = net_b, net_a
+    for beh in net_b.members:
+        beh.net = net_a
+    net_a.members.update(net_b.members)
+    net_b.members = None
+
+
+def _split(a, b):
+    '''
+    The last edge between a and b is removed. Search from both of them,
+    one behaviour from each side in turn, until the searches meet (the
+    network is whole) or one of the sides is over (it's a network now).
+    '''
+    seen_a = {a: None}
+    seen_b = {b: None}
+    stack_a = [a]
+    stack_b = [b]
+    while True:
+        for seen, stack, seen_other in ((seen_a, stack_a, seen_b), (seen_b, stack_b, seen_a)):
+            if not stack:
+                _split_off(seen)
+                return
+            beh = stack.pop()
+            for other, _ in beh.net_links.values():
+                if other in seen_other:
+                    return  # still connected
+                if not(other in seen):
+                    seen[other] = None
+                    stack += [other]
+
+
+def _split_off(members):
+    '''
+    Move members from their network to a new one.
+    '''
+    old_members = next(iter(members)).net.members
+    net = cNetwork(members)
+    for beh in members:
+        beh.net = net
+        del old_members[beh]
@@ -4,272 +4,380 @@ Different aspects of storage and delivery
 
 
 import logging
+from collections import deque
+from math import ceil
 
 from simcubes.behaviours.basebehaviour import cSimulBehaviour
-from simcubes.simcore import cEvent
+from simcubes.simcore import cEvent, cWaitQueue, cStateMachine
+from simcubes.en import ServiceTypes
 
 logger = logging.getLogger(__name__)
 
 
-class cBehItemStorage(cSimulBehaviour):
+class cBehItemHolder(cSimulBehaviour):
+    '''
+    Base class for behaviours that keep items. A thread that can't take
+    items from here (or put items here) waits in not_empty (not_full)
+    queue and is woken with it's pending transfer when the condition
+    becomes true, see the events below.
+
+    A self_driven behaviour both fills and drains itself in it's run. It
+    can't wait for it's own quantity (it would never be woken), so an
+    event that finds it changed by a neighbour is just skipped.
+    '''
+
+    __slots__ = ('quantity', 'max_quantity', 'not_empty', 'not_full')
+
+    self_driven = False
 
     def __init__(self, parent):
         super().__init__(parent)
         self.quantity = 0
-        self.max_quantity = 50
-        self.pullers = []
-        self.pushers = []
+        self.max_quantity = 0
+        self.not_empty = cWaitQueue()
+        self.not_full = cWaitQueue()
 
-    def connect_to(self, other_behaviour, puller=False, pusher=False):
-        super().connect_to(other_behaviour)
-        if puller:
-            self.pullers += [other_behaviour]
-        if pusher:
-            self.pushers += [other_behaviour]
+    def is_active(self):
+        # a storage keeps providing while it has items
+        return self.quantity > 0 or (self.is_running() and super().is_active())
 
-    def disconnect_from(self, other_behaviour):
-        super().disconnect_from(other_behaviour)
-        if isinstance(other_behaviour, cBehItemPullPush):
-
-            try:
-                i = self.pullers.index(other_behaviour)
-                self.pullers.pop(i)
-            except ValueError:
-                # it's ok
-                pass
-
-            try:
-                i = self.pushers.index(other_behaviour)
-                self.pushers.pop(i)
-            except ValueError:
-                # it's ok
-                pass
+    def can_go_dormant(self):
+        return self.quantity == 0 and super().can_go_dormant()
 
-    def run(self):
-        pass
+    def has_room_for(self, quantity):
+        return self.quantity + quantity <= self.max_quantity
 
     def put(self, quantity):
-
-        if self.quantity + quantity > self.max_quantity:
+        if not self.has_room_for(quantity):
             return False
-
-        # The storage changes it's state to "have something"
-        if self.quantity == 0 and quantity > 0:
-            for p in self.pullers:
-                p.get_poked()
-
         self.quantity += quantity
+        if quantity > 0:
+            self.not_empty.notify_all()
+            if self.quantity == quantity:
+                # got the first items, not idle any more
+                if self.dormant:
+                    self.leave_dormancy()
+                elif self.clients:
+                    self.inform_connected_about_activation()
         return True
 
     def take(self, quantity):
-
         if self.quantity - quantity < 0:
             return False
+        self.quantity -= quantity
+        if quantity > 0:
+            self.not_full.notify_all()
+            if self.quantity == 0 and self.clients and not self.is_active():
+                self.inform_connected_about_deactivation()
+        return True
 
-        for p in self.pushers:
-            p.get_poked()
 
-        self.quantity -=quantity
-        return True
+class cBehItemStorage(cBehItemHolder):
+
+    __slots__ = ('pullers', 'pushers')
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.max_quantity = 50
+        self.pullers = {}  # ordered sets, behaviour -> None
+        self.pushers = {}
+
+    def get_service_types(self):
+        return [ServiceTypes.serProvideItems, ServiceTypes.serReceiveItems]
+
+    def connect_to(self, other_behaviour, puller=False, pusher=False):
+        super().connect_to(other_behaviour)
+        if puller:
+            self.pullers[other_behaviour] = None
+        if pusher:
+            self.pushers[other_behaviour] = None
+
+    def get_connection_flags(self, other_behaviour):
+        return {'puller': other_behaviour in self.pullers, 'pusher': other_behaviour in self.pushers}
+
+    def connect_to_client(self, other_behaviour, service_type):
+        # the client takes items from here or puts items here
+        self.connect_to(other_behaviour,
+                        puller=(service_type == ServiceTypes.serProvideItems),
+                        pusher=(service_type == ServiceTypes.serReceiveItems))
+
+    def disconnect_from(self, other_behaviour):
+        super().disconnect_from(other_behaviour)
+        if isinstance(other_behaviour, cBehItemTransport):
+            self.pullers.pop(other_behaviour, None)
+            self.pushers.pop(other_behaviour, None)
+
+    def run(self):
+        pass
 
     def get_poked(self):
         pass
 
 
-class cBehSpawn(cSimulBehaviour):
+class cBehSpawn(cStateMachine, cBehItemHolder):
+
+    __slots__ = ('per_period', 'period', 'pullers')
+
+    periodic = True
 
     def __init__(self, parent):
         super().__init__(parent)
-        self.quantity = 0
         self.per_period = 1
         self.period = 0.5
         self.max_quantity = 10
-        self.pullers = []
+        self.pullers = {}  # an ordered set, behaviour -> None
+
+    def get_service_types(self):
+        return [ServiceTypes.serProvideItems]
 
     def connect_to(self, other_behaviour, puller=False):
         super().connect_to(other_behaviour)
         if puller:
-            self.pullers += [other_behaviour]
-
-    def disconnect_from(self, other_behaviour):
-        super().disconnect_from(other_behaviour)
-        if isinstance(other_behaviour, cBehItemPullPush):
-            try:
-                i = self.pullers.index(other_behaviour)
-                self.pullers.pop(i)
-            except ValueError:
-                # it's ok
-                pass
-
-    def run(self):
-        while True:
-            yield cEventSpawnItem(self, self.period, self, self.per_period)
-
-    def put(self, quantity):
+            self.pullers[other_behaviour] = None
 
-        if self.quantity + quantity > self.max_quantity:
-            return False
+    def get_connection_flags(self, other_behaviour):
+        return {'puller': other_behaviour in self.pullers}
 
-        # The storage changes it's state to "have something"
-        if self.quantity == 0 and quantity > 0:
-            for p in self.pullers:
-                p.get_poked()
+    def connect_to_client(self, other_behaviour, service_type):
+        self.connect_to(other_behaviour, puller=(service_type == ServiceTypes.serProvideItems))
 
-        self.quantity += quantity
-        return True
+    def disconnect_from(self, other_behaviour):
+        super().disconnect_from(other_behaviour)
+        if isinstance(other_behaviour, cBehItemTransport):
+            self.pullers.pop(other_behaviour, None)
 
-    def take(self, quantity):
+    def spawn(self):
+        return cEventSpawnItem(self, self.period, self, self.per_period)
 
-        self.get_poked()
+    transitions = ((spawn, 0),)
 
-        if self.quantity - quantity < 0:
-            return False
 
-        self.quantity -=quantity
-        return True
+class cBehItemTransport(cBehItemHolder):
+    '''
+    Base class for behaviours that move items from a source to a sink.
+    Goes dormant when the source is idle (see cSimulBehaviour.go_dormant).
+    '''
 
+    __slots__ = ('source', 'sink')
 
-class cBehPullItem(cSimulBehaviour):
+    needed_services = (ServiceTypes.serProvideItems,)
 
     def __init__(self, parent):
         super().__init__(parent)
-        self.quantity = 0
-        self.max_quantity = 2
-        self.period = 1
-        self.per_period = 1
         self.source = None
         self.sink = None
 
+    def get_service_types(self):
+        return [ServiceTypes.serProvideItems, ServiceTypes.serReceiveItems]
+
     def connect_to(self, other_behaviour, source=False, sink=False):
         super().connect_to(other_behaviour)
         if source:
             self.source = other_behaviour
+            self.add_provider(other_behaviour, ServiceTypes.serProvideItems)
         if sink:
             self.sink = other_behaviour
 
-    def run(self):
-        while True:
-            yield cEventPullItem(self, self.period, self.source, self.per_period)
+    def get_connection_flags(self, other_behaviour):
+        return {'source': self.source is other_behaviour, 'sink': self.sink is other_behaviour}
 
-    def put(self, quantity):
-        self.get_poked()
-        if self.quantity + quantity > self.max_quantity:
-            return False
+    def connect_to_client(self, other_behaviour, service_type):
+        # we give items to the one who needs them, we take items
+        # from the one who needs a receiver
+        self.connect_to(other_behaviour,
+                        source=(service_type == ServiceTypes.serReceiveItems),
+                        sink=(service_type == ServiceTypes.serProvideItems))
 
-        if self.quantity == 0 and quantity > 0:
-            if not self.sink is None:
-                self.sink.get_poked()
+    def connect_to_provider(self, other_behaviour, service_type):
+        self.connect_to(other_behaviour,
+                        source=(service_type == ServiceTypes.serProvideItems),
+                        sink=(service_type == ServiceTypes.serReceiveItems))
 
-        self.quantity += quantity
-        return True
-
-    def take(self, quantity):
-        self.get_poked()
-        if self.quantity - quantity < 0:
-            return False
+    def disconnect_from(self, other_behaviour):
+        super().disconnect_from(other_behaviour)
+        if self.source is other_behaviour:
+            self.source = None
+        if self.sink is other_behaviour:
+            self.sink = None
 
-        if not self.source is None:
-            self.source.get_poked()
 
-        self.quantity -=quantity
-        return True
+class cBehPullItem(cStateMachine, cBehItemTransport):
 
+    __slots__ = ('period', 'per_period')
 
-class cBehPushItem(cSimulBehaviour):
+    periodic = True
 
     def __init__(self, parent):
         super().__init__(parent)
-        self.quantity = 0
         self.max_quantity = 2
         self.period = 1
         self.per_period = 1
-        self.source = None
-        self.sink = None
-
-    def connect_to(self, other_behaviour, source=False, sink=False):
-        super().connect_to(other_behaviour)
-        if source:
-            self.source = other_behaviour
-        if sink:
-            self.sink = other_behaviour
-
-    def run(self):
-        while True:
-            yield cEventPushItem(self, self.period, self.sink, self.per_period)
 
-    def put(self, quantity):
+    def pull(self):
+        return cEventPullItem(self, self.period, self.source, self.per_period)
 
-        self.get_poked()
+    transitions = ((pull, 0),)
 
-        if self.quantity + quantity > self.max_quantity:
-            return False
 
-        if self.quantity == 0 and quantity > 0:
-            if not self.sink is None:
-                self.sink.get_poked()
+class cBehPushItem(cStateMachine, cBehItemTransport):
 
-        self.quantity += quantity
-        return True
+    __slots__ = ('period', 'per_period')
 
-    def take(self, quantity):
+    periodic = True
 
-        self.get_poked()
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.max_quantity = 2
+        self.period = 1
+        self.per_period = 1
 
-        if self.quantity - quantity < 0:
-            return False
+    def push(self):
+        return cEventPushItem(self, self.period, self.sink, self.per_period)
 
-        if not self.source is None:
-            self.source.get_poked()
+    transitions = ((push, 0),)
 
-        self.quantity -= quantity
-        return True
+# don't use it. Kept as a generator thread (custom logic in run)
+class cBehItemPullPush(cBehItemTransport):
 
-# don't use it
-class cBehItemPullPush(cSimulBehaviour):
+    periodic = True
+    self_driven = True
 
     def __init__(self, parent):
         super().__init__(parent)
-        self.quantity = 0
         self.max_quantity = 5
         self.period = 0.2
         self.per_period = 1
-        self.source = None
-        self.sink = None
-
-    def connect_to(self, other_behaviour, source=False, sink=False):
-        super().connect_to(other_behaviour)
-        if source:
-            self.source = other_behaviour
-        if sink:
-            self.sink = other_behaviour
 
 
     def run(self):
         while True:
-            success = yield cEventPullItem(self, self.period, self.source, self.per_period)
-            success = yield cEventPushItem(self, self.period, self.sink, self.per_period)
+            # Nobody else frees the room or brings items here, so don't
+            # wait for this behaviour itself. Don't wait for the source
+            # either while there is something to push.
+            if self.has_room_for(self.per_period) and (self.quantity < self.per_period or (
+                    self.source is not None and self.source.quantity >= self.per_period)):
+                success = yield cEventPullItem(self, self.period, self.source, self.per_period)
+            if self.quantity >= self.per_period:
+                success = yield cEventPushItem(self, self.period, self.sink, self.per_period)
+
+
+class cBehBeltSegment(cStateMachine, cBehItemTransport):
+    '''
+    A chain of conveyors (cBehItemPullPush, each one is the source of the
+    next one) merged into one behaviour, see merge_belt. The items are not
+    moved from conveyor to conveyor: the segment keeps the times they arrive
+    at the output end. An item pulled at t arrives at
+    t + length * transit_per_cube, so it costs two events (the pull and the
+    delivery) whatever the length is.
+
+    The events happen on a grid of periods starting at the last step, so
+    there are just a few different durations.
+    The items that arrived wait at the end while the sink is full, the next
+    ones stack behind them (see get_item_positions).
+    '''
+
+    __slots__ = ('members', 'arrivals', 'period', 'per_period', 'transit_per_cube', 'next_pull', 'next_delivery')
+
+    self_driven = True
+
+    def __init__(self, parent, members):
+        '''
+        :param parent: the first conveyor
+        :param members: the merged behaviours, from the input end to the output end
+        '''
+        super().__init__(parent)
+        self.members = members
+        self.arrivals = deque()  # the arrival times, the first one goes out first
+        self.period = members[0].period
+        self.per_period = members[0].per_period
+        self.transit_per_cube = 2 * self.period  # a pull and a push for each conveyor
+        self.max_quantity = sum(beh.max_quantity for beh in members)
+        self.next_pull = 0  # don't pull or deliver before these times
+        self.next_delivery = 0
+
+    def get_length(self):
+        return len(self.members)
+
+    def has_arrived(self, quantity):
+        arrivals = self.arrivals
+        return len(arrivals) >= quantity and arrivals[quantity - 1] <= self.get_time() + 1e-6
 
     def put(self, quantity):
-        if self.quantity + quantity > self.max_quantity:
+        if not self.has_room_for(quantity):
             return False
-
-        if self.quantity == 0 and quantity > 0:
-            if not self.sink is None:
-                self.sink.get_poked()
-
-        self.quantity += quantity
-        return True
+        self.arrivals += [self.get_time() + self.get_length() * self.transit_per_cube] * quantity
+        return super().put(quantity)
 
     def take(self, quantity):
-        if self.quantity - quantity < 0:
+        # only the items at the output end
+        if not self.has_arrived(quantity):
             return False
-
-        if self.quantity == 0 and quantity > 0:
-            if not self.sink is None:
-                self.sink.get_poked()
-
-        self.quantity -=quantity
-        return True
+        for _ in range(quantity):
+            self.arrivals.popleft()
+        return super().take(quantity)
+
+    def transfer(self):
+        '''
+        The only action of the state machine: pull or deliver, whatever
+        is the first. Delivers first if both are due and the sink has room.
+        '''
+        now = self.get_time()
+        period = self.period
+        source = self.source
+        sink = self.sink
+        arrivals = self.arrivals
+        # don't wait for the source while there are items to deliver
+        can_pull = source is not None and self.has_room_for(self.per_period) and \
+                   (not arrivals or source.quantity >= self.per_period)
+        if arrivals:
+            # periods to wait, rounded up to the grid
+            n_deliver = max(0, ceil((max(arrivals[0], self.next_delivery) - now) / period - 1e-6))
+            sink_has_room = sink is not None and sink.has_room_for(self.per_period)
+            if not can_pull or (sink_has_room and n_deliver <= ceil((self.next_pull - now) / period - 1e-6)):
+                # one item per transit_per_cube at each end, as a conveyor does
+                self.next_delivery = now + n_deliver * period + self.transit_per_cube
+                return cEventBeltDeliver(self, n_deliver * period, self.per_period)
+        if can_pull:
+            n_pull = max(0, ceil((self.next_pull - now) / period - 1e-6))
+            self.next_pull = now + n_pull * period + self.transit_per_cube
+            return cEventPullItem(self, n_pull * period, source, self.per_period)
+        # no source and no items, the segment is restarted on the new connections
+        return None
+
+    transitions = ((transfer, 0),)
+
+    def get_item_positions(self, now=None):
+        '''
+        :param now: (optional) the time, the simulation time by default. It
+                doesn't go on while there are no events, so the game engine
+                may pass it's own time.
+        :return: a list with the positions of the items along the belt in
+                cubes, 0 is the input end, get_length() is the output end.
+                The first item is the closest one to the output.
+        '''
+        if now is None:
+            now = 0 if self.env is None else self.get_time()
+        length = self.get_length()
+        gap = length / self.max_quantity  # the items don't overlap
+        positions = []
+        limit = length
+        for arrival in self.arrivals:
+            pos = max(0.0, min(limit, length - max(0.0, arrival - now) / self.transit_per_cube))
+            positions += [pos]
+            limit = pos - gap
+        return positions
+
+    def get_cube_quantities(self, now=None):
+        '''
+        :param now: see get_item_positions
+        :return: a list with the number of items on each conveyor, from the input end
+        '''
+        length = self.get_length()
+        quantities = [0] * length
+        for pos in self.get_item_positions(now):
+            # an item on the border belongs to the conveyor before it
+            quantities[min(length - 1, max(0, ceil(pos - 1e-6) - 1))] += 1
+        return quantities
 
 ###
 # Events
@@ -277,6 +385,8 @@ class cBehItemPullPush(cSimulBehaviour):
 
 class cEventSpawnItem(cEvent):
 
+    __slots__ = ('target', 'quantity')
+
     priority = 1
 
     def __init__(self, beh, duration, target, quantity):
@@ -287,12 +397,16 @@ class cEventSpawnItem(cEvent):
     def apply(self):
         if self.target is None:
             return False
-        is_spawned = self.target.put(self.quantity)
-        return is_spawned
+        if not self.target.put(self.quantity):
+            self.target.not_full.wait(self.beh)
+            return False
+        return True
 
 
 class cEventPullItem(cEvent):
 
+    __slots__ = ('source', 'quantity')
+
     priority = 3
 
     def __init__(self, beh, duration, source, quantity):
@@ -303,19 +417,22 @@ class cEventPullItem(cEvent):
     def apply(self):
         if self.source is None:
             return False
-        is_pulled = self.source.take(self.quantity)
-        if not is_pulled:
+        if not self.beh.has_room_for(self.quantity):
+            if self.beh.self_driven:
+                return True  # filled by a pusher meanwhile, nothing to pull
+            self.beh.not_full.wait(self.beh)
             return False
-        is_balanced = self.beh.put(self.quantity)
-        if not is_balanced:
-            # logger.warning("Pull failed to balance")
-            self.source.put(self.quantity)  # rollback
+        if not self.source.take(self.quantity):
+            self.source.not_empty.wait(self.beh)
             return False
+        self.beh.put(self.quantity)
         return True
 
 
 class cEventPushItem(cEvent):
 
+    __slots__ = ('sink', 'quantity')
+
     priority = 2
 
     def __init__(self, beh, duration, sink, quantity):
@@ -326,27 +443,115 @@ class cEventPushItem(cEvent):
     def apply(self):
         if self.sink is None:
             return False
-        is_taken = self.beh.take(self.quantity)
-        if not is_taken:
+        if self.beh.quantity < self.quantity:
+            if self.beh.self_driven:
+                return True  # drained by a puller meanwhile, nothing to push
+            self.beh.not_empty.wait(self.beh)
             return False
-        is_pushed = self.sink.put(self.quantity)
-        if not is_pushed:
-            logger.warning("Push failed to balance")
-            self.beh.put(self.quantity)  # rollback
+        if not self.sink.put(self.quantity):
+            self.sink.not_full.wait(self.beh)
             return False
+        self.beh.take(self.quantity)
         return True
 
 
-if __name__ == '__main__':
-    from misc import lg
-    lg.config_logging()
+class cEventBeltDeliver(cEvent):
+    '''
+    cBehBeltSegment gives the items at the output end to the sink.
+    '''
 
-    from simcubes.simcore import cSimEnvironment
-    from misc.exec import realtime_batch_simulation_cycle, one_time_simulation
-    from misc.observers import add_observers
+    __slots__ = ('quantity',)
 
-    env = cSimEnvironment()
+    priority = 4
+
+    def __init__(self, beh, duration, quantity):
+        super().__init__(beh, duration)
+        self.quantity = quantity
 
+    def apply(self):
+        beh = self.beh
+        if beh.sink is None:
+            return False
+        if not beh.has_arrived(self.quantity):
+            return True  # taken by a puller meanwhile, nothing to deliver
+        if not beh.sink.put(self.quantity):
+            beh.sink.not_full.wait(beh)
+            return False
+        beh.take(self.quantity)
+        return True
+
+
+# Merging the conveyor chains
+
+def merge_belt(members, parent):
+    '''
+    Replace a chain of cBehItemPullPush behaviours with a cBehBeltSegment.
+    The outer connections and the items are moved to the segment, the
+    chain behaviours are disconnected from each other. Stop the threads of
+    the chain before the call.
+    :param members: the chain, from the input end to the output end.
+            Each one is the source of the next one.
+    :param parent: the holder of the segment
+    :return: the segment, not started
+    '''
+    seg = cBehBeltSegment(parent, members)
+    now = 0 if members[0].env is None else members[0].get_time()
+    length = len(members)
+    # the items closer to the output end arrive first
+    for i in reversed(range(length)):
+        seg.arrivals += [now + (length - i) * seg.transit_per_cube] * members[i].quantity
+        seg.quantity += members[i].quantity
+        members[i].quantity = 0
+    in_chain = set(members)
+    for beh in members:
+        for other in list(beh.connected):
+            if other in in_chain:
+                beh.disconnect_from(other)
+            else:
+                _move_connection(beh, other, seg)
+    return seg
+
+
+def split_belt(seg):
+    '''
+    The opposite of merge_belt, the items go to the conveyors they are on.
+    Stop the segment thread before the call.
+    :return: the chain behaviours, not started
+    '''
+    members = seg.members
+    for beh, quantity in zip(members, seg.get_cube_quantities()):
+        beh.quantity = quantity
+    seg.arrivals.clear()
+    seg.quantity = 0
+    for prev, beh in zip(members, members[1:]):
+        prev.connect_to(beh, sink=True)
+        beh.connect_to(prev, source=True)
+    for other in list(seg.connected):
+        # the output end has the sink, the rest goes to the input end
+        _move_connection(seg, other, members[-1] if seg.sink is other else members[0])
+    return members
+
+
+def _move_connection(old, other, new):
+    '''
+    Connect new to other the same way old is connected (see get_connection_flags),
+    and disconnect old.
+    '''
+    flags = old.get_connection_flags(other)
+    other_flags = other.get_connection_flags(old)
+    if other in old.connected:
+        old.disconnect_from(other)
+    if old in other.connected:
+        other.disconnect_from(old)
+    new.connect_to(other, **flags)
+    other.connect_to(new, **other_flags)
+
+
+def build_farm_to_box_chain():
+    '''
+    A small hand-made chain without cubes: farm -> puller -> pusher -> pusher -> box.
+    :return: a list of behaviours, not started yet
+    '''
     farm = cBehSpawn("FARM")
     pull1 = cBehPullItem("PULLER 1")
     push1 = cBehPushItem("PUSHER 1")
@@ -385,7 +590,20 @@ if __name__ == '__main__':
     # conv1.connect_to(conv2, source=False, sink=True)
     # conv2.connect_to(conv1, source=True, sink=False)
 
-    env.start_threads([farm, pull1, push1, push2, box1])
+    return [farm, pull1, push1, push2, box1]
+
+
+if __name__ == '__main__':
+    from misc import lg
+    lg.config_logging()
+
+    from simcubes.simcore import cSimEnvironment
+    from misc.exec import realtime_batch_simulation_cycle, one_time_simulation
+    from misc.observers import add_observers
+
+    env = cSimEnvironment()
+
+    env.start_threads(build_farm_to_box_chain())
 
     # Add periodically observing threads
     data_collector = add_observers(env, period=0.01)
@@ -394,4 +612,3 @@ if __name__ == '__main__':
     one_time_simulation(env, 25)
 
     data_collector.do_plot()
-
@@ -2,13 +2,15 @@
 Different kind of grounds, including ores.
 '''
 
-from simcubes.world import cSimCube
+from simcubes.world import cSimCube, register_passive_cube
 from simcubes.en import CubeTypes
 
 from simcubes.behaviours.eco import cBehBlooming
 
 class cGrass(cSimCube):
 
+    static_walls = True
+
     def init_behaviours(self):
         self.cube_type = CubeTypes.blGrass
         beh = cBehBlooming(self)
@@ -16,3 +18,27 @@ class cGrass(cSimCube):
         self.register_behaviour(beh)
 
 
+class cBedRock(cSimCube):
+    '''
+    Passive, kept in the chunk arrays until somebody needs the cube.
+    '''
+
+    static_walls = True
+
+    def init_behaviours(self):
+        self.cube_type = CubeTypes.blBedRock
+
+
+class cSand(cSimCube):
+    '''
+    Passive, kept in the chunk arrays until somebody needs the cube.
+    '''
+
+    static_walls = True
+
+    def init_behaviours(self):
+        self.cube_type = CubeTypes.blSand
+
+
+register_passive_cube(CubeTypes.blBedRock, cBedRock)
+register_passive_cube(CubeTypes.blSand, cSand)
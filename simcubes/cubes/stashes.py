@@ -9,6 +9,8 @@ from simcubes.behaviours.storage import cBehItemStorage
 
 class cBox(cSimCube):
 
+    static_walls = True
+
     def init_behaviours(self):
         self.cube_type = CubeTypes.blBox
         # This behaviour is registered twice. This would help other
@@ -5,10 +5,14 @@ Conveyors, ?roads
 from simcubes.world import cSimCube
 from simcubes.en import CubeTypes, ServiceTypes, AliasOrientation
 
-from simcubes.behaviours.storage import cBehItemPullPush
+from simcubes.behaviours.storage import cBehItemPullPush, merge_belt, split_belt
 
 class cConveyor(cSimCube):
 
+    static_walls = True
+    # shorter chains are not merged into belts
+    MIN_BELT_LENGTH = 2
+
     def init_behaviours(self):
         self.cube_type = CubeTypes.blConveyor
         # This behaviour is registered twice. This would help other
@@ -16,6 +20,79 @@ class cConveyor(cSimCube):
         beh = cBehItemPullPush(self)
         for serv_type in beh.get_service_types():
             self.register_behaviour(beh, serv_type)
+        self.pull_push = beh
+        self.belt = None  # cBehBeltSegment when merged, see merge_connected_blocks
+        self.belt_index = 0  # the place in the belt, from the input end
+
+    def get_quantity(self, now=None):
+        '''
+        :param now: see cBehBeltSegment.get_item_positions
+        :return: number of items on this conveyor (for rendering)
+        '''
+        if self.belt is None:
+            return self.pull_push.quantity
+        return self.belt.get_cube_quantities(now)[self.belt_index]
+
+    @classmethod
+    def merge_connected_blocks(cls, world, blocks):
+        '''
+        Chains of conveyors (each one takes items from the previous one)
+        become belt segments, see storage.cBehBeltSegment. The segment
+        is a behaviour of the first conveyor, the rest have no behaviours
+        until unmerge.
+        '''
+        by_beh = {bl.pull_push: bl for bl in blocks if bl.belt is None}
+        for bl in by_beh.values():
+            prev = by_beh.get(bl.pull_push.source)
+            if prev is not None and prev.pull_push.sink is bl.pull_push:
+                continue  # not the first one
+            chain = [bl]
+            while True:
+                nxt = by_beh.get(chain[-1].pull_push.sink)
+                if nxt is None or not(nxt.pull_push.source is chain[-1].pull_push):
+                    break
+                chain += [nxt]
+            if len(chain) >= cls.MIN_BELT_LENGTH:
+                cls._merge_chain(chain)
+
+    @staticmethod
+    def _merge_chain(chain):
+        members = [bl.pull_push for bl in chain]
+        env = members[0].env
+        if env is not None:
+            for beh in members:
+                env.stop_a_thread(beh)
+        seg = merge_belt(members, chain[0])
+        for i, bl in enumerate(chain):
+            bl.unregister_behaviour(bl.pull_push)
+            bl.belt = seg
+            bl.belt_index = i
+        for serv_type in seg.get_service_types():
+            chain[0].register_behaviour(seg, serv_type)
+        if env is not None:
+            env.start_a_thread(seg)
+
+    def unmerge(self):
+        '''
+        Split the belt back into conveyors
+        :return: the conveyors of the belt, see cSimCube.unmerge
+        '''
+        seg = self.belt
+        if seg is None:
+            return []
+        env = seg.env
+        if env is not None:
+            env.stop_a_thread(seg)
+        members = split_belt(seg)
+        seg.parent.unregister_behaviour(seg)
+        for beh in members:
+            bl = beh.parent
+            bl.belt = None
+            for serv_type in beh.get_service_types():
+                bl.register_behaviour(beh, serv_type)
+        if env is not None:
+            env.start_threads(members)
+        return [beh.parent for beh in members]
 
     def expose_cubewall_provided_service_types(self, rel_orientation):
         '''
@@ -23,8 +100,8 @@ class cConveyor(cSimCube):
         '''
         if rel_orientation == AliasOrientation.Front:
             return [ServiceTypes.serProvideItems]
-        # if rel_orientation == AliasOrientation.Back:
-        #     return [ServiceTypes.serReceiveItems]
+        if rel_orientation == AliasOrientation.Back:
+            return [ServiceTypes.serReceiveItems]
 
     def expose_cubewall_requested_service_types(self, rel_orientation):
         '''
@@ -33,6 +110,6 @@ class cConveyor(cSimCube):
         if rel_orientation == AliasOrientation.Back:
             # so we need someone to provide items to this block's back wall.
             return [ServiceTypes.serProvideItems]
-        # if rel_orientation == AliasOrientation.Front:
-        #     # and we need someone to receive our items from the front wall
-        #     return [ServiceTypes.serReceiveItems]
\ No newline at end of file
+        if rel_orientation == AliasOrientation.Front:
+            # and we need someone to receive our items from the front wall
+            return [ServiceTypes.serReceiveItems]
@@ -50,6 +50,15 @@ class BehaviourTypes(IntEnum):
     BehItemPullPush = 1
 
 
+class ServiceTypes(IntEnum):
+    '''
+    How behaviours are exposed to each other over the cube walls,
+    "ser" for easier finding. 0 is for internal behaviours.
+    '''
+    serProvideItems = 1  # items can be taken from here
+    serReceiveItems = 2  # items can be put here
+
+
 class CubeTypes(IntEnum):
     '''
     Cube types, "bl" for easier finding
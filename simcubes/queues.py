@@ -0,0 +1,798 @@
+'''
+Scheduler backends for cSimSchedule. The schedule doesn't care how the
+events are ordered inside, it talks to a backend via cSchedulerBackend
+interface: push, pop_due, peek, cancel and size. So different
+realisations can be swapped in here (see make_backend and QUEUES).
+
+The standard backend is cQueueBackend. It keeps the events in an event
+queue (a plain ordered container - a heap, a calendar queue...), the events
+of periodic threads in an (optional) timing wheel, and implements
+cancellations with lazy deletion. cChunkedBackend keeps a cQueueBackend
+for each chunk of the world and merges their heads.
+
+The queues are ordered by integer keys. A key packs the event time in
+ticks, the event priority and the insertion sequence number into one
+int, see make_key. So the keys are unique and comparing two entries
+never touches the events themselves. The sequence number alone is unique
+as well, cancellations are tracked by it (a backend may shift the time
+of it's entries, see cChunkedBackend).
+'''
+
+from heapq import heappush, heappop, heapify
+from bisect import insort
+from collections import deque
+
+SEQ_BITS = 40  # about 10^12 events in one schedule
+PRIORITY_BITS = 8
+PRIORITY_LIMIT = 1 << PRIORITY_BITS
+TICK_SHIFT = SEQ_BITS + PRIORITY_BITS
+SEQ_MASK = (1 << SEQ_BITS) - 1
+
+
+def make_key(tick, priority, seq):
+    '''
+    :param tick: event time in integer ticks
+    :param priority: event priority, 0 <= priority < PRIORITY_LIMIT (ValueError otherwise)
+    :param seq: insertion sequence number (stable order for equal tick and priority)
+    :return: an integer key, keys order like (tick, priority, seq) tuples
+    '''
+    if not(0 <= priority < PRIORITY_LIMIT):
+        # it would spill into the tick bits
+        raise ValueError("Event priority {} is out of 0..{}".format(priority, PRIORITY_LIMIT - 1))
+    return (tick << TICK_SHIFT) | (priority << SEQ_BITS) | seq
+
+
+def key_to_tick(key):
+    return key >> TICK_SHIFT
+
+
+def key_to_priority(key):
+    return (key >> SEQ_BITS) & ((1 << PRIORITY_BITS) - 1)
+
+
+def key_to_seq(key):
+    return key & SEQ_MASK
+
+
+NO_LIMIT = float('inf')  # an until_key for pop_due that never stops
+
+
+class cSchedulerBackend:
+    '''
+    The interface between cSimSchedule and the queues. Entries are
+    (key, event) tuples with unique integer keys, the smallest key goes
+    first. The schedule makes the keys, a backend only keeps the order.
+    '''
+
+    def push(self, key, ev):
+        '''
+        :param key: unique integer key, see make_key
+        :param ev: an event (or a timer) to keep
+        '''
+        raise NotImplementedError
+
+    def pop_due(self, until_key):
+        '''
+        Take the earliest entry if it's key is less than until_key.
+        :return: a tuple (key, event_reference) or None
+        '''
+        raise NotImplementedError
+
+    def peek(self):
+        '''
+        :return: the earliest entry (key, event_reference), it stays in the
+                backend. None if there are no entries.
+        '''
+        raise NotImplementedError
+
+    def cancel(self, key, ev):
+        '''
+        The entry with this key would never be returned.
+        :param key: a key of an entry in the backend
+        :param ev: the event of the entry (cChunkedBackend finds the chunk by it)
+        '''
+        raise NotImplementedError
+
+    def size(self):
+        '''
+        :return: number of entries (not counting the cancelled ones)
+        '''
+        raise NotImplementedError
+
+    # The chunks of the world, only cChunkedBackend keeps the events by chunk
+
+    def pause(self, chunk_id, now):
+        raise NotImplementedError("chunks need the 'chunked' backend")
+
+    def resume(self, chunk_id, now):
+        raise NotImplementedError("chunks need the 'chunked' backend")
+
+    def is_paused(self, chunk_id):
+        raise NotImplementedError("chunks need the 'chunked' backend")
+
+    def unload(self, chunk_id):
+        raise NotImplementedError("chunks need the 'chunked' backend")
+
+    def chunk_size(self, chunk_id):
+        raise NotImplementedError("chunks need the 'chunked' backend")
+
+    def iter_chunks(self):
+        raise NotImplementedError("chunks need the 'chunked' backend")
+
+
+class cEventQueue:
+    '''
+    The interface of an event queue - an ordered container for cQueueBackend.
+    Entries are (key, event) tuples with unique integer keys, the smallest
+    key goes first.
+    '''
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def push(self, key, ev):
+        raise NotImplementedError
+
+    def pop(self):
+        '''
+        :return: a tuple (key, event_reference)
+        '''
+        raise NotImplementedError
+
+    def peek(self):
+        '''
+        Same as pop, but the entry stays in the queue.
+        :return: a tuple (key, event_reference)
+        '''
+        raise NotImplementedError
+
+    def compact(self, dead_seqs):
+        '''
+        Drop the cancelled entries.
+        :param dead_seqs: a set with sequence numbers (see key_to_seq)
+                of the cancelled entries
+        '''
+        raise NotImplementedError
+
+    def __iter__(self):
+        '''
+        Iterate over the entries, in no particular order.
+        '''
+        raise NotImplementedError
+
+
+class cHeapQueue(cEventQueue):
+    '''
+    A plain binary heap. O(log n) for each push and pop.
+    This is the default queue.
+    '''
+
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, key, ev):
+        heappush(self._heap, (key, ev))
+
+    def pop(self):
+        return heappop(self._heap)
+
+    def peek(self):
+        return self._heap[0]
+
+    def compact(self, dead_seqs):
+        self._heap = [e for e in self._heap if not ((e[0] & SEQ_MASK) in dead_seqs)]
+        heapify(self._heap)
+
+    def __iter__(self):
+        return iter(self._heap)
+
+
+class cCalendarQueue(cEventQueue):
+    '''
+    A calendar queue (R. Brown, 1988). Time is cut into buckets of the
+    same width, like days in a calendar. A bucket holds all the events
+    of its 'day' for every 'year', in a heap (a lot of events may share
+    a tick, a sorted list would cost O(bucket) for them). Dequeue goes
+    day after day and takes only the events of the current year.
+
+    When the events are dense in a narrow time band (that's our case with
+    0.1 - 1.0 second timeouts of thousands of cubes) this gives amortised
+    O(1) for both enqueue and dequeue. The number of buckets follows the
+    queue size and the bucket width is re-estimated from the event
+    separation on each resize.
+    '''
+
+    def __init__(self, nbuckets=16, width=10000):
+        '''
+        :param nbuckets: initial number of buckets (grows with the queue)
+        :param width: initial bucket width in ticks
+        '''
+        self._size = 0
+        self._min_buckets = nbuckets
+        self._setup(nbuckets, width)
+
+    def _setup(self, nbuckets, width):
+        self._nbuckets = nbuckets
+        self._width = width
+        self._buckets = [[] for _ in range(nbuckets)]
+        self._cur = 0  # the virtual bucket ("day" number since 0) of the cursor
+        self._head = None  # the bucket found by peek, for the next pop
+
+    def __len__(self):
+        return self._size
+
+    def push(self, key, ev):
+        vb = (key >> TICK_SHIFT) // self._width
+        heappush(self._buckets[vb % self._nbuckets], (key, ev))
+        if vb < self._cur:
+            # the cursor has gone past this day (peek moves it), step back
+            self._cur = vb
+            self._head = None
+        self._size += 1
+        if self._size > 2 * self._nbuckets:
+            self._resize(2 * self._nbuckets)
+
+    def pop(self):
+        bucket = self._head
+        if bucket is None:
+            bucket = self._find_head()
+        else:
+            self._head = None  # the next event in it may be of a later year
+        entry = heappop(bucket)
+        self._size -= 1
+        if self._size < self._nbuckets // 2 and self._nbuckets > self._min_buckets:
+            self._resize(self._nbuckets // 2)
+        return entry
+
+    def peek(self):
+        bucket = self._head
+        if bucket is None:
+            bucket = self._head = self._find_head()
+        return bucket[0]
+
+    def compact(self, dead_seqs):
+        self._head = None
+        for i, b in enumerate(self._buckets):
+            self._buckets[i] = b = [e for e in b if not ((e[0] & SEQ_MASK) in dead_seqs)]
+            heapify(b)
+        self._size = sum(map(len, self._buckets))
+
+    def __iter__(self):
+        for b in self._buckets:
+            yield from b
+
+    def _find_head(self):
+        '''
+        Move the cursor to the day of the earliest event.
+        :return: the bucket with the earliest event in its head
+        '''
+        if self._size == 0:
+            raise IndexError('peek from an empty calendar queue')
+        buckets = self._buckets
+        n = self._nbuckets
+        width = self._width
+        vb = self._cur
+        for _ in range(n):
+            b = buckets[vb % n]
+            if b and (b[0][0] >> TICK_SHIFT) // width == vb:
+                self._cur = vb
+                return b
+            vb += 1
+        # A whole year is empty, the queue is sparse. Jump directly
+        # to the earliest event.
+        b = min((b for b in buckets if b), key=lambda b: b[0][0])
+        self._cur = (b[0][0] >> TICK_SHIFT) // width
+        return b
+
+    def _resize(self, nbuckets):
+        entries = [e for b in self._buckets for e in b]
+        entries.sort(key=lambda e: e[0])
+        self._setup(nbuckets, self._estimate_width(entries))
+        for e in entries:
+            vb = (e[0] >> TICK_SHIFT) // self._width
+            self._buckets[vb % nbuckets].append(e)  # entries are sorted, so it's a heap
+        if entries:
+            self._cur = (entries[0][0] >> TICK_SHIFT) // self._width
+
+    def _estimate_width(self, entries):
+        '''
+        Brown's heuristic: three times the average separation of the
+        nearest events. The simultaneous events count (as zero gaps), so
+        a day holds about three events however many of them share a tick.
+        The nearest events are the first eighth of the queue, at least 25.
+        :param entries: sorted queue entries
+        '''
+        ticks = [e[0] >> TICK_SHIFT for e in entries[:max(25, len(entries) // 8)]]
+        if len(ticks) < 2 or ticks[-1] == ticks[0]:
+            return self._width
+        return max(1, 3 * (ticks[-1] - ticks[0]) // (len(ticks) - 1))
+
+
+class cTimingWheel(cEventQueue):
+    '''
+    A hierarchical timing wheel (Varghese & Lauck, 1987) for the recurring
+    timers. Time is counted in integer ticks, each level is a wheel of
+    2^BITS slots and a slot of the level k covers 2^(BITS*k) ticks. A timer
+    is put to the lowest level which still has the cursor's "rotation", and
+    a slot of a higher level is cascaded down when the cursor reaches it.
+    So each timer is touched a few times (once per level at most) and there
+    is no heap involved at all.
+
+    All the timers of a level 0 slot have the same tick, so the slot is a
+    deque in the key order: the timers mostly come in that order (the same
+    priority, growing sequence numbers) and are appended, the others are
+    inserted. A cascaded slot is sorted once and appended.
+
+    The next non-empty slot is found with a bitmap per level, the empty slots
+    are never iterated.
+
+    Timers before the cursor or behind the horizon are not accepted (push
+    returns False), the schedule keeps them in its general queue.
+    '''
+
+    BITS = 8
+    LEVELS = 4
+
+    def __init__(self):
+        self._mask = (1 << self.BITS) - 1
+        self._slots = [[deque() for _ in range(1 << self.BITS)]] + \
+                      [[[] for _ in range(1 << self.BITS)] for _ in range(self.LEVELS - 1)]
+        self._bitmaps = [0] * self.LEVELS
+        self._cursor = 0  # all the timers are at this tick or later
+        self._head = None  # the level 0 slot found by the last _find_head
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, key, ev):
+        tick = key >> TICK_SHIFT
+        horizon = self.BITS * self.LEVELS
+        if tick < self._cursor or (tick >> horizon) != (self._cursor >> horizon):
+            return False
+        self._insert(tick, (key, ev))
+        self._size += 1
+        return True
+
+    def pop(self):
+        # The head slot stays the head until it's empty: the timers pushed
+        # meanwhile are at the cursor tick (the same slot) or later.
+        bucket = self._head
+        if not bucket:
+            bucket = self._find_head()
+        entry = bucket.popleft()
+        if not bucket:
+            self._bitmaps[0] &= ~(1 << (self._cursor & self._mask))
+        self._size -= 1
+        return entry
+
+    def peek(self):
+        bucket = self._head
+        if not bucket:
+            bucket = self._find_head()
+        return bucket[0]
+
+    def compact(self, dead_seqs):
+        self._size = 0
+        self._head = None
+        for level, slots in enumerate(self._slots):
+            for slot, entries in enumerate(slots):
+                if not entries:
+                    continue
+                entries = [e for e in entries if not ((e[0] & SEQ_MASK) in dead_seqs)]
+                slots[slot] = deque(entries) if level == 0 else entries
+                self._size += len(entries)
+                if not entries:
+                    self._bitmaps[level] &= ~(1 << slot)
+
+    def __iter__(self):
+        for slots in self._slots:
+            for entries in slots:
+                yield from entries
+
+    def _insert(self, tick, entry):
+        # the highest differing bit of the tick and the cursor gives the level
+        level = ((tick ^ self._cursor).bit_length() - 1) // self.BITS
+        if level <= 0:
+            slot = tick & self._mask
+            bucket = self._slots[0][slot]
+            if bucket and entry[0] < bucket[-1][0]:
+                insort(bucket, entry)  # a higher priority than the last one
+            else:
+                bucket.append(entry)
+            self._bitmaps[0] |= 1 << slot
+        else:
+            slot = (tick >> (self.BITS * level)) & self._mask
+            self._slots[level][slot].append(entry)
+            self._bitmaps[level] |= 1 << slot
+
+    def _find_head(self):
+        '''
+        Move the cursor to the earliest timer, cascading the higher levels.
+        :return: the level 0 slot (a deque) with the earliest timers
+        '''
+        mask = self._mask
+        bucket = self._slots[0][self._cursor & mask]
+        if bucket:
+            # still at the same tick
+            self._head = bucket
+            return bucket
+        if self._size == 0:
+            raise IndexError('peek from an empty timing wheel')
+        while True:
+            c = self._cursor
+            idx = c & mask
+            bm = self._bitmaps[0] >> idx
+            if bm:
+                slot = idx + (bm & -bm).bit_length() - 1
+                self._cursor = (c & ~mask) | slot
+                bucket = self._head = self._slots[0][slot]
+                return bucket
+            # nothing left in this rotation of the level 0, take the next
+            # non-empty slot of the higher levels and spread it down
+            for level in range(1, self.LEVELS):
+                shift = self.BITS * level
+                idx = ((c >> shift) & mask) + 1
+                bm = self._bitmaps[level] >> idx
+                if bm:
+                    slot = idx + (bm & -bm).bit_length() - 1
+                    upper = shift + self.BITS
+                    self._cursor = ((c >> upper) << upper) | (slot << shift)
+                    entries = self._slots[level][slot]
+                    self._slots[level][slot] = []
+                    self._bitmaps[level] &= ~(1 << slot)
+                    entries.sort()  # the keys are unique, the events are never compared
+                    if level == 1:
+                        # all of them go to the level 0, which is empty now
+                        slots = self._slots[0]
+                        bitmap = self._bitmaps[0]
+                        for e in entries:
+                            slot = (e[0] >> TICK_SHIFT) & mask
+                            slots[slot].append(e)
+                            bitmap |= 1 << slot
+                        self._bitmaps[0] = bitmap
+                    else:
+                        for e in entries:
+                            self._insert(e[0] >> TICK_SHIFT, e)
+                    break
+            else:
+                raise IndexError('timing wheel lost its timers')
+
+
+class cQueueBackend(cSchedulerBackend):
+    '''
+    The standard backend: a general event queue plus (optional) a timing
+    wheel for the events of periodic threads. Cancelled entries stay in the
+    containers, but they are skipped. When there are too many of them, the
+    containers are compacted.
+    '''
+
+    # The queues are compacted when there are more cancelled events
+    # than COMPACT_MIN and they are more than COMPACT_RATIO of all the events.
+    COMPACT_MIN = 64
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, queue=None, use_wheel=False):
+        '''
+        :param queue: (optional) an instance of cEventQueue, cHeapQueue by default.
+        :param use_wheel: keep the events of periodic threads in a
+                timing wheel instead of the general queue. Off by default:
+                in pure Python the heap (heapq is in C) is still faster on
+                the grass plains, the wheel is kept to compare (misc.conformance).
+        '''
+        if queue is None:
+            queue = cHeapQueue()
+        self._queue = queue
+        self._wheel = cTimingWheel() if use_wheel else None
+        self._in_queue = 0  # number of entries in the queue
+        self._in_wheel = 0  # and in the wheel, including the cancelled ones
+        self._head_in_wheel = False  # where the last _peek_raw found the entry
+        self._dead = set()  # sequence numbers of the cancelled events that are still in the queues
+
+    def push(self, key, ev):
+        if ev.beh.periodic and self._wheel is not None and self._wheel.push(key, ev):
+            self._in_wheel += 1
+        else:
+            self._queue.push(key, ev)
+            self._in_queue += 1
+
+    def pop_due(self, until_key):
+        while True:
+            entry = self._peek_raw()
+            if entry is None or entry[0] >= until_key:
+                return None
+            # _pop_raw inlined, this is the hottest path
+            if self._head_in_wheel:
+                self._in_wheel -= 1
+                self._wheel.pop()
+            else:
+                self._in_queue -= 1
+                self._queue.pop()
+            if self._dead and (entry[0] & SEQ_MASK) in self._dead:
+                self._dead.discard(entry[0] & SEQ_MASK)
+                entry[1].release()
+                continue
+            return entry
+
+    def peek(self):
+        while True:
+            entry = self._peek_raw()
+            if entry is None or not(self._dead and (entry[0] & SEQ_MASK) in self._dead):
+                return entry
+            self._pop_raw()
+            self._dead.discard(entry[0] & SEQ_MASK)
+            entry[1].release()
+
+    def cancel(self, key, ev=None):
+        self._dead.add(key & SEQ_MASK)
+        n_dead = len(self._dead)
+        if n_dead > self.COMPACT_MIN and n_dead > self.COMPACT_RATIO * (self._in_queue + self._in_wheel):
+            self.compact()
+
+    def size(self):
+        return self._in_queue + self._in_wheel - len(self._dead)
+
+    def compact(self, dead_seqs=None):
+        '''
+        Drop all the cancelled events from the queues.
+        :param dead_seqs: (optional) more entries to drop, a set of sequence
+                numbers (see key_to_seq)
+        '''
+        if dead_seqs:
+            self._dead |= dead_seqs
+        self._queue.compact(self._dead)
+        self._in_queue = len(self._queue)
+        if self._wheel is not None:
+            self._wheel.compact(self._dead)
+            self._in_wheel = len(self._wheel)
+        self._dead = set()
+
+    def iter_events(self):
+        '''
+        :return: an iterator over the events (not the cancelled ones), in no
+                particular order
+        '''
+        dead = self._dead
+        for queue in (self._queue, self._wheel):
+            if queue is not None:
+                for key, ev in queue:
+                    if not((key & SEQ_MASK) in dead):
+                        yield ev
+
+    def _peek_raw(self):
+        '''
+        Finds the next entry in the queue or in the wheel and remembers where
+        it is for _pop_raw.
+        :return: the earliest entry, cancelled or not. None if there are no entries.
+        '''
+        if self._in_wheel:
+            wheel_head = self._wheel.peek()
+            if not self._in_queue:
+                self._head_in_wheel = True
+                return wheel_head
+            queue_head = self._queue.peek()
+            self._head_in_wheel = wheel_head[0] < queue_head[0]
+            return wheel_head if self._head_in_wheel else queue_head
+        self._head_in_wheel = False
+        if self._in_queue:
+            return self._queue.peek()
+        return None
+
+    def _pop_raw(self):
+        '''
+        Pops the entry found by the last _peek_raw.
+        '''
+        if self._head_in_wheel:
+            self._in_wheel -= 1
+            return self._wheel.pop()
+        self._in_queue -= 1
+        return self._queue.pop()
+
+
+class cChunkedBackend(cSchedulerBackend):
+    '''
+    A sub-schedule (cQueueBackend) for each chunk of the world, the events
+    go to the chunk of their thread (ev.beh.chunk_id). A small top-level
+    heap merges the heads of the sub-schedules, so a pop costs log of the
+    number of chunks plus log of the chunk size. Each sub-schedule keeps
+    it's own cancelled events.
+
+    A chunk may be paused (it's events are kept, but not applied), resumed
+    (the events are shifted by the paused time) and unloaded (the
+    sub-schedule is taken out). All of them are O(1). Sub-schedules keep
+    local keys: global key = local key + chunk offset (in ticks, shifted).
+    '''
+
+    def __init__(self, queue='heap', use_wheel=False):
+        '''
+        :param queue: a name from QUEUES, the queue for each chunk
+        :param use_wheel: see cQueueBackend
+        '''
+        self._queue_class = QUEUES[queue]
+        self._use_wheel = use_wheel
+        self._subs = {}  # chunk_id -> cQueueBackend
+        self._offsets = {}  # chunk_id -> shift of local keys (already << TICK_SHIFT)
+        self._paused = {}  # chunk_id -> tick of the pause
+        self._heads = {}  # chunk_id -> global key of it's head in self._top
+        self._top = []  # heap of (global key, chunk_id), stale entries are skipped
+        self._size = 0  # events in all the subs, not counting the cancelled ones
+        self._now = 0  # the tick of the last pop (the schedule time), see push
+
+    def push(self, key, ev):
+        chunk_id = ev.beh.chunk_id
+        sub = self._subs.get(chunk_id)
+        if sub is None:
+            sub = self._subs[chunk_id] = cQueueBackend(self._queue_class(), self._use_wheel)
+            self._offsets[chunk_id] = 0
+        self._size += 1
+        paused_at = self._paused.get(chunk_id)
+        if paused_at is not None:
+            # resume shifts by the whole pause, this event waits only
+            # for the rest of it
+            sub.push(key - self._offsets[chunk_id] - ((self._now - paused_at) << TICK_SHIFT), ev)
+            return
+        sub.push(key - self._offsets[chunk_id], ev)
+        head = self._heads.get(chunk_id)
+        if head is None or key < head:
+            self._heads[chunk_id] = key
+            heappush(self._top, (key, chunk_id))
+
+    def pop_due(self, until_key):
+        top = self._peek_top()
+        if top is None or top[0] >= until_key:
+            return None
+        return self._pop_top()
+
+    def peek(self):
+        top = self._peek_top()
+        if top is None:
+            return None
+        key, chunk_id = top
+        return key, self._subs[chunk_id].peek()[1]
+
+    def cancel(self, key, ev):
+        chunk_id = ev.beh.chunk_id
+        sub = self._subs.get(chunk_id)
+        if sub is None:
+            return  # unloaded with it's chunk
+        sub.cancel(key)  # the sequence number is the same in the local key
+        self._size -= 1
+        head = self._heads.get(chunk_id)
+        if head is not None and (head & SEQ_MASK) == (key & SEQ_MASK):
+            self._register_head(chunk_id)  # the sub skips it, the next one is the head
+
+    def size(self):
+        return self._size
+
+    def compact(self):
+        '''
+        Drop all the cancelled events from the sub-schedules.
+        '''
+        for sub in self._subs.values():
+            sub.compact()
+
+    def pause(self, chunk_id, now):
+        '''
+        Stop applying the events of the chunk. New events are still accepted.
+        :param now: current tick of the schedule
+        '''
+        if chunk_id in self._paused:
+            return
+        self._now = now
+        self._paused[chunk_id] = now
+        self._heads.pop(chunk_id, None)  # the entry in self._top is stale now
+
+    def resume(self, chunk_id, now):
+        '''
+        Apply the events of the chunk again, they are delayed by the paused
+        time (the events scheduled during the pause - by the rest of it).
+        :param now: current tick of the schedule
+        '''
+        self._now = now
+        paused_at = self._paused.pop(chunk_id, None)
+        if paused_at is None:
+            return
+        if chunk_id in self._subs:
+            self._offsets[chunk_id] += (now - paused_at) << TICK_SHIFT
+            self._register_head(chunk_id)
+
+    def is_paused(self, chunk_id):
+        return chunk_id in self._paused
+
+    def unload(self, chunk_id):
+        '''
+        Take the sub-schedule of the chunk out, the other chunks are not touched.
+        :return: cQueueBackend with local keys or None. The cancelled events
+                are still there, but it skips them.
+        '''
+        self._heads.pop(chunk_id, None)
+        self._paused.pop(chunk_id, None)
+        self._offsets.pop(chunk_id, None)
+        sub = self._subs.pop(chunk_id, None)
+        if sub is not None:
+            self._size -= sub.size()
+        return sub
+
+    def chunk_size(self, chunk_id):
+        '''
+        :return: number of the scheduled events of the chunk
+        '''
+        sub = self._subs.get(chunk_id)
+        return 0 if sub is None else sub.size()
+
+    def iter_chunks(self):
+        return iter(self._subs.keys())
+
+    def _register_head(self, chunk_id):
+        head = self._subs[chunk_id].peek()
+        if head is None:
+            self._heads.pop(chunk_id, None)
+            return
+        key = head[0] + self._offsets[chunk_id]
+        self._heads[chunk_id] = key
+        heappush(self._top, (key, chunk_id))
+
+    def _peek_top(self):
+        '''
+        :return: the earliest valid (global key, chunk_id) from self._top or None
+        '''
+        top = self._top
+        while top:
+            entry = top[0]
+            if self._heads.get(entry[1]) == entry[0]:
+                return entry
+            heappop(top)
+        return None
+
+    def _pop_top(self):
+        '''
+        Pops the head of the chunk found by the last _peek_top.
+        :return: (global key, event)
+        '''
+        key, chunk_id = heappop(self._top)
+        ev = self._subs[chunk_id].pop_due(NO_LIMIT)[1]
+        self._size -= 1
+        self._now = key >> TICK_SHIFT
+        self._register_head(chunk_id)
+        return key, ev
+
+
+# Event queues by name, register more to compare them (see misc.conformance)
+QUEUES = {
+    'heap': cHeapQueue,
+    'calendar': cCalendarQueue,
+    'chunked': cChunkedBackend,  # a sub-schedule (with heaps) per chunk
+}
+
+
+def register_queue(name, queue_class):
+    '''
+    :param name: a name to select the queue with make_backend
+    :param queue_class: a cEventQueue subclass (constructed without arguments),
+                a cSchedulerBackend subclass (constructed with use_wheel)
+                or any callable that returns a cSchedulerBackend
+    '''
+    QUEUES[name] = queue_class
+
+
+def make_backend(backend=None, use_wheel=False):
+    '''
+    :param backend: one of
+            None - a heap;
+            a name from QUEUES ('chunked' for cChunkedBackend);
+            an instance of cEventQueue;
+            an instance of cSchedulerBackend (used as is).
+    :param use_wheel: see cQueueBackend
+    :return: a cSchedulerBackend instance
+    '''
+    if isinstance(backend, str):
+        backend = QUEUES[backend]
+        if isinstance(backend, type) and issubclass(backend, cSchedulerBackend):
+            return backend(use_wheel=use_wheel)
+        backend = backend()
+    if isinstance(backend, cSchedulerBackend):
+        return backend
+    return cQueueBackend(backend, use_wheel)
@@ -1,6 +1,7 @@
 
-from heapq import heappush, heappop
-from itertools import count
+from time import perf_counter
+
+from simcubes.queues import make_backend, make_key, key_to_tick, key_to_priority, TICK_SHIFT, SEQ_BITS, NO_LIMIT
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,9 +13,15 @@ class cSimEnvironment:
     activates and deactives them.
     '''
 
-    def __init__(self):
-        self.threads = []  # used only for observing, the mechanics don't rely on this list yet
-        self.schedule = cSimSchedule()
+    def __init__(self, backend=None, use_wheel=False):
+        '''
+        :param backend: (optional) scheduler backend, a name from queues.QUEUES
+                or an instance, see cSimSchedule. A binary heap by default.
+        :param use_wheel: keep the events of periodic threads in a timing wheel
+                (see queues.cQueueBackend).
+        '''
+        self.threads = {}  # an ordered set, thread -> None; used only for observing, not in the mechanics
+        self.schedule = cSimSchedule(backend, use_wheel)
 
     def get_time(self):
         '''
@@ -37,13 +44,23 @@ class cSimEnvironment:
         a chain reaction.
         '''
         async_thread.set_environment(self)
-        self.threads += [async_thread]  # this is not used in core mechanics
+        self.threads[async_thread] = None  # this is not used in core mechanics
         async_thread.first_step()  # this would call cSimSchedule.schedule_event
 
     def start_threads(self, iter_over_threads):
         for thr_i in iter_over_threads:
             self.start_a_thread(thr_i)
 
+    def stop_a_thread(self, async_thread):
+        '''
+        Cancel the scheduled event of the thread and forget it.
+        '''
+        async_thread.stop()
+        try:
+            del self.threads[async_thread]
+        except KeyError:
+            logger.warning("An attempt to stop unknown thread")
+
 
 class cSimSchedule:
     '''
@@ -52,79 +69,267 @@ class cSimSchedule:
     schedule.
     '''
 
-    def __init__(self):
-        self._heap = []  # a heap to hold the events
+    # apply_next_tick looks at the clock once per this number of events
+    BUDGET_CHECK_EVERY = 16
+
+    def __init__(self, backend=None, use_wheel=False, ticks_per_second=100000):
+        '''
+        :param backend: (optional) where to keep the events, see queues.make_backend.
+                A name ('heap', 'calendar', 'chunked'), a queues.cEventQueue or a
+                queues.cSchedulerBackend instance. A heap by default, use
+                'calendar' when there are a lot of short events.
+        :param use_wheel: keep the events of periodic threads in a
+                timing wheel instead of the general queue, see queues.cQueueBackend.
+        :param ticks_per_second: resolution of the simulation clock. The clock
+                counts integer ticks, event durations are rounded to ticks.
+        '''
+        self._backend = make_backend(backend, use_wheel)  # holds the events in the key order, see queues.make_key
         self._recent_events = []  # these eventes just happened and not visible in the game yet
-        self._now = 0.0
+        self._tps = ticks_per_second
+        self._seq = 0  # insertion counter, makes the order of equal events stable
+        self._now = 0  # in ticks
+        self._lag = 0  # see get_lag
+        self._behind = False  # see is_behind
 
     def get_time(self):
-        return self._now
+        return self._now / self._tps
+
+    def seconds_to_ticks(self, seconds):
+        '''
+        :param seconds: simulation time in seconds
+        :return: integer number of ticks
+        '''
+        return int(round(seconds * self._tps))
 
     def peek_next_event(self):
         '''
         :return: a tuple (event_time, event_priority, event_reference)
         (unpack for destoying a reference to the actual schedule)
+        :raises IndexError: if the schedule is empty
         '''
-        T, P, an_event = self._heap[0]
-        return T, P, an_event
+        key, an_event = self._peek()
+        return key_to_tick(key) / self._tps, key_to_priority(key), an_event
 
     def peek_next_timestamp(self):
-        return self._heap[0][0]
+        '''
+        :return: time of the next event
+        :raises IndexError: if the schedule is empty
+        '''
+        return key_to_tick(self._peek()[0]) / self._tps
+
+    def _peek(self):
+        head = self._backend.peek()
+        if head is None:
+            raise IndexError('the schedule is empty')
+        return head
 
     def schedule_event(self, ev):
         '''
         Schedule an event with a
         :param ev: some event with known duration
+        :return: a handle to cancel the event
+        '''
+        key = make_key(self._now + self.seconds_to_ticks(ev.duration), ev.priority, self._seq)
+        self._seq += 1
+        self._backend.push(key, ev)
+        return key
+
+    def cancel(self, handle, ev):
+        '''
+        Cancel a scheduled event, it would never be applied.
+        :param handle: what schedule_event returned. The handle should
+                be of a pending event (don't cancel applied events).
+        :param ev: the event
+        '''
+        self._backend.cancel(handle, ev)
+
+    def size(self):
+        '''
+        :return: number of the scheduled events
+        '''
+        return self._backend.size()
+
+    # Chunks, works with the 'chunked' backend only (queues.cChunkedBackend),
+    # the others raise NotImplementedError
+
+    def pause_chunk(self, chunk_id):
+        '''
+        The events of the chunk are kept, but not applied until resume_chunk.
+        '''
+        self._backend.pause(chunk_id, self._now)
+
+    def resume_chunk(self, chunk_id):
+        '''
+        The events of the chunk are delayed by the time it was paused.
         '''
-        heappush(self._heap, (round(self._now + ev.duration, 5), ev.priority, ev))
+        self._backend.resume(chunk_id, self._now)
 
-    def apply_next_tick(self, until_T):
+    def unload_chunk(self, chunk_id):
+        '''
+        Drop the events of the chunk from the schedule. The threads of these
+        events are left without a scheduled event, as if it was cancelled.
+        :return: the sub-schedule of the chunk (see queues.cChunkedBackend.unload)
+        '''
+        sub = self._backend.unload(chunk_id)
+        if sub is not None:
+            for an_event in sub.iter_events():
+                thr = an_event.beh
+                if thr.pending_event is an_event:
+                    # the handle is of this schedule, don't cancel it here
+                    thr.pending_handle = None
+                    thr.pending_event = None
+        return sub
+
+    def chunk_size(self, chunk_id):
+        '''
+        :return: number of the scheduled events in the chunk
+        '''
+        return self._backend.chunk_size(chunk_id)
+
+    def apply_next_tick(self, until_T, max_events=None, max_ms=None):
         '''
         Game engine should call this method frequently (each 0.1 seconds).
         This call 'reserves' all the events up to the moment until_T. They
         will be activated right at the moment of the call, however the game
         should synchronise them with graphical representation.
         :param until_T: simulation time, we reserve the events up to this moment.
+        :param max_events: (optional) apply no more than this number of events.
+        :param max_ms: (optional) stop after this number of milliseconds of
+                real time (checked every BUDGET_CHECK_EVERY events).
         :return: a list with activated events (so that game engine can easily
                 find all the corresponding cubes).
 
         ..warning:
-            If some of the threads produce only zero duration events, this call
-            may never end.
+            If some of the threads produce only zero duration events and there
+            is no budget, this call may never end.
+
+        ..note:
+            When the budget is over, the rest of the due events stay in the
+            schedule and would be applied by the next call. is_behind() and
+            get_lag() tell whether and how much simulation time is left behind.
+
+        ..note:
+            Events of the classes with process_batch are applied in groups,
+            see cEvent.process_batch.
 
         ..note:
             Game engine is reponsible to INCREF and DECREF for events, they'll be
-            garbage collected on the next tick, when we empty self._recent_events.
+            released to the event pool on the next tick, when we empty
+            self._recent_events. Don't keep them longer.
 
         ..note:
             Game engine should read the states from the blocks after this call,
             before the next call.
         '''
 
-        # There can be a lot of additional things here - like events cancellations
-
+        for an_event in self._recent_events:
+            an_event.release()
         self._recent_events = []  # free the references
-        while self.peek_next_timestamp() <= until_T:
-            self._now, P, an_event = heappop(self._heap)
+        self._lag = 0
+        self._behind = False
+        backend = self._backend
+        # all the keys of the due events are below this one
+        until_key = (int(until_T * self._tps + 1e-6) + 1) << TICK_SHIFT
+        if max_events is None:
+            max_events = -1  # never reached
+        deadline = None if max_ms is None else perf_counter() + max_ms / 1000
+        applied = 0
+        next_check = self.BUDGET_CHECK_EVERY  # look at the clock when applied gets here
+        while True:
+            out_of_budget = applied == max_events
+            if not out_of_budget and deadline is not None and applied >= next_check:
+                next_check = applied + self.BUDGET_CHECK_EVERY
+                out_of_budget = perf_counter() > deadline
+            if out_of_budget:
+                # out of budget, the rest is for the next call
+                head = backend.peek()
+                if head is not None and head[0] < until_key:
+                    self._lag = until_T - key_to_tick(head[0]) / self._tps
+                    self._behind = True
+                break
+            entry = backend.pop_due(until_key)
+            if entry is None:
+                break
+            key, an_event = entry
+            self._now = key >> TICK_SHIFT
             #logger.info("Simulation time is incremented up to " + str(self._now))
-            if not an_event.cancelled:
-                # applies an event and schedules the next one
-                # so after this process_step() call new events
-                # are heappuched inside self._heap.
-                an_event.process_step()
-                self._recent_events += [an_event]
+            if an_event.cancelled:
+                continue
+            if an_event.process_batch is not None:
+                limit = max_events - applied - 1  # negative for no limit
+                if deadline is not None and not(0 <= limit < next_check - applied):
+                    # the batch ends at the next look at the clock
+                    limit = next_check - applied - 1
+                batch = self._pop_batch(key, an_event, until_key, limit)
+                an_event.process_batch(batch)
+                self._recent_events += batch
+                applied += len(batch)
+                continue
+            # applies an event and schedules the next one
+            # so after this process_step() call new events
+            # are pushed into the backend.
+            an_event.process_step()
+            self._recent_events += [an_event]
+            applied += 1
         return self._recent_events
 
+    def _pop_batch(self, key, first_event, until_key, limit):
+        '''
+        Pop the due events of the same class, time and priority which go
+        right after the first event of the batch.
+        :param key: key of the first event (already popped)
+        :param first_event: the first event of the batch
+        :param until_key: see apply_next_tick
+        :param limit: take no more than this number of events (except
+                the first one), negative for no limit
+        :return: a list of the events in the schedule order
+        '''
+        batch = [first_event]
+        cls = first_event.__class__
+        same_moment = key >> SEQ_BITS  # time and priority
+        backend = self._backend
+        while limit != 0:
+            head = backend.peek()  # skips the cancelled ones
+            if head is None or (head[0] >> SEQ_BITS) != same_moment or head[1].__class__ is not cls:
+                break
+            key, an_event = backend.pop_due(until_key)
+            if an_event.cancelled:
+                continue
+            batch += [an_event]
+            limit -= 1
+        return batch
+
+    def is_behind(self):
+        '''
+        :return: True if the last apply_next_tick call ran out of it's budget
+                and there are due events left.
+        '''
+        return self._behind
+
+    def get_lag(self):
+        '''
+        :return: how far (in simulation seconds) the schedule is behind
+                the until_T of the last apply_next_tick call. This is 0 unless
+                the call ran out of it's budget (and may be 0 even then, if the
+                events left are at until_T).
+        '''
+        return self._lag
+
     def apply_event_after_event(self):
         '''
         Iterative call to apply events until forced to be stoped.
         '''
         while True:
-            self._now, P, an_event = heappop(self._heap)
+            entry = self._backend.pop_due(NO_LIMIT)
+            if entry is None:
+                return
+            key, an_event = entry
+            self._now = key >> TICK_SHIFT
             #logger.info("Simulation time is incremented up to " + str(self._now))
             if not an_event.cancelled:
                 an_event.process_step()
-            yield self._now
+            an_event.release()
+            yield self.get_time()
 
 
 class cAsyncThread:
@@ -134,19 +339,43 @@ class cAsyncThread:
     thread in the simulation.
     '''
 
-    thread_count = count(0)
+    __slots__ = ('thread_id', 'env', 'pending_handle', 'pending_event', 'generator_state', 'state',
+                 'last_failed_event', 'dormant_event', 'snoozed', 'wait_queue', 'timer', 'chunk_id')
+
+    next_thread_id = 0  # the ids are unique, restored threads move it past theirs
+    # Set this to True if the thread produces events with the same
+    # duration over and over. Such events are kept in a timing wheel.
+    periodic = False
 
     def __init__(self):
-        self.thread_id = next(self.thread_count)
+        self.thread_id = cAsyncThread.next_thread_id
+        cAsyncThread.next_thread_id += 1
         self.env = None  # to be set upon cSimEnvironment.start_a_thread
-        self.do_schedule = None  # to be set upon cSimEnvironment.start_a_thread
+        self.pending_handle = None  # handle of the scheduled event of this thread
+        self.pending_event = None  # and the event itself
         self.generator_state = None  # to be set after
+        self.state = cStateMachine.STOPPED  # used by the state machines only
         self.last_failed_event = None  # event that was right before the snooze call
+        self.dormant_event = None  # cancelled event kept for later, see cSimulBehaviour.go_dormant
         self.snoozed = False
+        self.wait_queue = None  # cWaitQueue the snoozed thread waits in
+        self.timer = cTimer(self)  # reused for all the timeouts of this thread
+        # The events go to the sub-schedule of this chunk (see queues.cChunkedBackend)
+        self.chunk_id = None
 
     def __eq__(self, other):
         return self.thread_id == other.thread_id
 
+    def __hash__(self):
+        # thread ids are unique, threads go into sets and dict keys
+        return self.thread_id
+
+    def __reduce_ex__(self, protocol):
+        # The connected threads keep each other in dicts, so the thread
+        # id should be there before the rest of the state is unpickled.
+        # Threads with a running generator can't be pickled.
+        return (_restore_thread, (self.__class__, self.thread_id)) + super().__reduce_ex__(protocol)[2:]
+
     def __repr__(self):
         return "thread {}".format(self.thread_id)
 
@@ -158,7 +387,49 @@ class cAsyncThread:
 
     def set_environment(self, env):
         self.env = env
-        self.do_schedule = lambda ev: env.schedule.schedule_event(ev)
+
+    def do_schedule(self, ev):
+        self.pending_handle = self.env.schedule.schedule_event(ev)
+        self.pending_event = ev
+
+    def cancel(self):
+        '''
+        Cancel the scheduled event of this thread (if any). The thread
+        stops stepping, since it's the event that makes the next step.
+        '''
+        if self.pending_handle is not None:
+            self.env.schedule.cancel(self.pending_handle, self.pending_event)
+            self.pending_handle = None
+            self.pending_event = None
+
+    def stop(self):
+        '''
+        Cancel the scheduled event and close the generator, the thread
+        would never step again (until the next first_step).
+        '''
+        self.cancel()
+        if self.generator_state is not None:
+            self.generator_state.close()
+            self.generator_state = None
+        self.snoozed = False
+        self.wait_queue = None
+        self.last_failed_event = None
+
+    def restart(self):
+        '''
+        Start the generator from scratch, for example when the
+        connections have changed (the scheduled event may refer
+        to a removed behaviour).
+        '''
+        self.stop()
+        self.first_step()
+
+    def is_running(self):
+        '''
+        :return: True if the thread was started and it's not stopped or over
+                (it may be snoozed though)
+        '''
+        return self.generator_state is not None
 
     def run(self):
         '''
@@ -168,7 +439,8 @@ class cAsyncThread:
         '''
         is_active = True
         while is_active:
-            # yield any cEvent here, timeout is obligatory
+            # yield any cEvent here, timeout is obligatory.
+            # A plain timeout is just a number: yield 0.5
             raise NotImplemented
 
     def first_step(self):
@@ -193,6 +465,10 @@ class cAsyncThread:
 
             # main generator loop here
             next_event = next(self.generator_state)
+            if next_event.__class__ is float or next_event.__class__ is int:
+                # a timeout, no need for an event
+                self.timer.duration = next_event
+                next_event = self.timer
             self.do_schedule(next_event)
 
         except StopIteration:
@@ -215,6 +491,7 @@ class cAsyncThread:
         if not self.snoozed:
             return
         self.snoozed = False
+        self.wait_queue = None
         if self.last_failed_event is None:
             # If the process just stoped without failure
             self.step()
@@ -230,17 +507,150 @@ class cAsyncThread:
         '''
         pass
 
+def _restore_thread(cls, thread_id):
+    thr = cls.__new__(cls)
+    thr.thread_id = thread_id
+    if thread_id >= cAsyncThread.next_thread_id:
+        # the threads created after the restore shouldn't collide with it
+        cAsyncThread.next_thread_id = thread_id + 1
+    return thr
+
+
+class cStateMachine:
+    '''
+    Mix this in front of a thread class to run a table of transitions
+    instead of the run() generator. There is no generator frame, the whole
+    state of the thread is a small int and the slots of it's class, so
+    such threads are small and can be pickled or copied.
+
+    transitions is a tuple indexed by the state: (action, next state).
+    On each step the thread calls the action of it's state and goes to the
+    next state. The action returns the event to wait for in there, a timeout
+    (a number), or None to stop. When the event is applied (or the timeout
+    is over), the thread steps again. A failed event is retried as usual
+    (see cEvent.process_step).
+
+    Example, same as "while True: yield 0.1; yield cSomeEvent(self, 0.2)":
+
+        class cBehExample(cStateMachine, cSimulBehaviour):
+            __slots__ = ()
+            def wait(self):
+                return 0.1
+            def do_something(self):
+                return cSomeEvent(self, 0.2)
+            transitions = ((wait, 1), (do_something, 0))
+    '''
+
+    __slots__ = ()
+
+    STOPPED = -1
+    transitions = ()
+    initial_state = 0
+
+    def first_step(self):
+        self.state = self.initial_state
+        self.step()
+
+    def step(self):
+        state = self.state
+        if state < 0 or self.snoozed:
+            return
+        action, self.state = self.transitions[state]
+        next_event = action(self)
+        if next_event is None:
+            # it's ok, state machines can stop
+            self.state = self.STOPPED
+            self.after_last_step()
+            return
+        if next_event.__class__ is float or next_event.__class__ is int:
+            self.timer.duration = next_event
+            next_event = self.timer
+        self.do_schedule(next_event)
+
+    def stop(self):
+        super().stop()
+        self.state = self.STOPPED
+
+    def is_running(self):
+        return self.state >= 0
+
+
+class cWaitQueue:
+    '''
+    A condition to wait for, like "the storage is not empty". An event
+    that failed calls wait(thread) from apply; the thread is snoozed with
+    the event saved for a retry (see cEvent.process_step). The owner of
+    the condition calls notify_all when it may have become true, the
+    threads are woken and retry their events.
+    A thread waits in one queue at a time.
+    '''
+
+    __slots__ = ('_threads',)
+
+    def __init__(self):
+        self._threads = []
+
+    def __len__(self):
+        return len(self._threads)
+
+    def wait(self, thread):
+        thread.wait_queue = self
+        self._threads += [thread]
+
+    def notify_all(self):
+        if not self._threads:
+            return
+        threads = self._threads
+        self._threads = []
+        for thr in threads:
+            # the thread may have been woken (or stopped) in another way
+            if thr.wait_queue is self:
+                thr.wake()
+
+
 # Events
 
 class cEvent:
     '''
-    Base event class. Useful aslo as a timeout.
+    Base event class. Useful aslo as a timeout (but a thread may
+    just yield a number of seconds, see cTimer).
     All the priorities should be diffrent, depending on the
     event class. The lower the value, the higher is the priority.
-    This sets execution order.
+    This sets execution order. Events with equal time and priority
+    are applied in the order they were scheduled.
+    Priority is a small int, 0 <= priority < 256.
+
+    Events are slotted and pooled: each event class has it's own list
+    of free instances, cEvent(...) takes one from there if possible.
+    The schedule returns the events to the pool with release() when
+    they are done. Subclasses should declare __slots__ as well.
     '''
 
+    __slots__ = ('beh', 'duration', 'cancelled')
+
     priority = 10
+    # Set this to a classmethod (cls, events) to apply all the events of
+    # this class due at the same time and priority in one call (cSimSchedule
+    # calls it instead of process_step). events is a list in the schedule
+    # order, it's popped before any of the events is applied (the budget
+    # of apply_next_tick may split it in several calls). So set it only if
+    # applying an event of the class never cancels the others and never
+    # schedules a zero duration event of a higher priority: then the result
+    # of the call must be the same as process_step for each event in turn,
+    # and the common part may be vectorized (with numpy, for example).
+    process_batch = None
+    POOL_MAX = 10000  # the pool of one event class doesn't grow further
+    _free = []  # the pool, each subclass gets it's own list
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._free = []
+
+    def __new__(cls, *args, **kwargs):
+        free = cls._free
+        if free:
+            return free.pop()
+        return object.__new__(cls)
 
     def __init__(self, beh, duration):
         self.beh = beh
@@ -248,11 +658,19 @@ class cEvent:
         # a way to cancel events (after block destruction for example)
         self.cancelled = False
 
-    def __lt__(self, other):
-        return self.priority < other.priority
-
-    def __eq__(self, other):
-        return self.priority == other.priority
+    def release(self):
+        '''
+        The event is done, put it back to the pool. Called by the schedule,
+        don't keep references to the released events.
+        Events kept by the threads for a retry are not released.
+        '''
+        beh = self.beh
+        if beh is None or beh.last_failed_event is self or beh.pending_event is self \
+                or beh.dormant_event is self:
+            return  # released already, kept for a retry or later, or scheduled again
+        if len(self._free) < self.POOL_MAX:
+            self.beh = None
+            self._free.append(self)
 
     def __repr__(self):
         return "EVENT {} planned by {}".format(self.__class__.__name__, self.beh)
@@ -272,12 +690,14 @@ class cEvent:
         So the next event is scheduled right after the previous one
         is applied
         '''
+        self.beh.pending_handle = None
+        self.beh.pending_event = None
         success = self.apply()
         if not success:
             logger.info("[t={}][{} - failed]".format(self.get_time(), self))
             self.beh.snooze()  # this would stop the behaviour generator
             self.rollback_in_case_of_failure()
-            self.beh.last_failured_event = self
+            self.beh.last_failed_event = self
             return
         if self.__class__.__name__ != "cEvent":  # omit the timeouts\
             logger.info("[t={}][{} - success]".format(self.get_time(), self))
@@ -299,4 +719,35 @@ class cEvent:
         So if apply logic changed some state before the failure, you can implement
         rollback operations here.
         '''
-        pass
\ No newline at end of file
+        pass
+
+
+class cTimer:
+    '''
+    A timeout entry. When a thread yields a number instead of an event,
+    this is scheduled instead. There is only one timer per thread (a thread
+    has only one scheduled event at a time), so timeouts don't allocate
+    anything. The timer is never applied or logged, it just steps the
+    thread.
+    '''
+
+    __slots__ = ('beh', 'duration')
+
+    priority = cEvent.priority
+    process_batch = None
+    cancelled = False
+
+    def __init__(self, beh):
+        self.beh = beh
+        self.duration = 0
+
+    def __repr__(self):
+        return "TIMEOUT of {}".format(self.beh)
+
+    def process_step(self):
+        self.beh.pending_handle = None
+        self.beh.pending_event = None
+        self.beh.step()
+
+    def release(self):
+        pass
@@ -10,44 +10,39 @@ from operator import mul
 
 # offset vectors
 
+ORIENTATION_VECTORS = {
+    Orientation.West: (-1, 0, 0),
+    Orientation.East: (1, 0, 0),
+    Orientation.South: (0, -1, 0),
+    Orientation.North: (0, 1, 0),
+    Orientation.Down: (0, 0, -1),
+    Orientation.Up: (0, 0, 1),
+}
+
+VECTOR_ORIENTATIONS = {v: o for o, v in ORIENTATION_VECTORS.items()}
+
+OPPOSING_DIRECTIONS = {o: VECTOR_ORIENTATIONS[(-v[0], -v[1], -v[2])] for o, v in ORIENTATION_VECTORS.items()}
+
 def orientation_to_vector(o):
     '''
     :param o: a member of Orientation
     :return: a tuple (x,y,z) directing towards the
              orientation. Like (1, 0, 0)
     '''
-    if o == Orientation.West:
-        return -1, 0, 0
-    if o == Orientation.East:
-        return 1, 0, 0
-    if o == Orientation.South:
-        return 0, -1, 0
-    if o == Orientation.North:
-        return 0, 1, 0
-    if o == Orientation.Down:
-        return 0, 0, -1
-    if o == Orientation.Up:
-        return 0, 0, 1
-    raise BaseException('Unhandled direction!')
+    vec = ORIENTATION_VECTORS.get(o)
+    if vec is None:
+        raise BaseException('Unhandled direction!')
+    return vec
 
 def vector_to_orientation(vec):
     '''
     :param vec: a tuple, (x, y, z), like (1, 0, 0)
     :return: a member of Orientation
     '''
-    if vec == (-1, 0, 0):
-        return Orientation.West
-    if vec == (1, 0, 0):
-        return Orientation.East
-    if vec == (0, -1, 0):
-        return Orientation.South
-    if vec == (0, 1, 0):
-        return Orientation.North
-    if vec == (0, 0, -1):
-        return Orientation.Down
-    if vec == (0, 0, 1):
-        return Orientation.Up
-    raise BaseException('Unhandled direction!')
+    o = VECTOR_ORIENTATIONS.get(tuple(vec))
+    if o is None:
+        raise BaseException('Unhandled direction!')
+    return o
 
 def get_opposing_direction(o):
     '''
@@ -57,25 +52,16 @@ def get_opposing_direction(o):
     :param o: a member of Orientation
     :return: opposing Orientation
     '''
-    if o == Orientation.West:
-        return Orientation.East
-    if o == Orientation.East:
-        return Orientation.West
-    if o == Orientation.South:
-        return Orientation.North
-    if o == Orientation.North:
-        return Orientation.South
-    if o == Orientation.Down:
-        return Orientation.Up
-    if o == Orientation.Up:
-        return Orientation.Down
-    raise BaseException('Unhandled direction!')
+    opposing = OPPOSING_DIRECTIONS.get(o)
+    if opposing is None:
+        raise BaseException('Unhandled direction!')
+    return opposing
 
 
 
 
 # full transformations
-# FIXME: this can be optimised a lot by doing some pre-calc
+# These are slow, they are used once at import to fill the tables below.
 
 def matmul3(A, B):
 
@@ -105,7 +91,7 @@ def matinv3(M):
                 A[0][1]*A[1][2]*A[2][0] + \
                 A[0][2]*A[1][0]*A[2][1] - \
                 A[0][2]*A[1][1]*A[2][0] - \
-                A[0][1]*A[0][1]*A[2][2] - \
+                A[0][1]*A[1][0]*A[2][2] - \
                 A[0][0]*A[1][2]*A[2][1]
 
     C = [[0, 0, 0],
@@ -203,6 +189,56 @@ def rotation_to_basis(r):
     if r == Rotation.Left:
         return R(0, 0, -pi/2)
 
+def calc_basis(orientation, rotation):
+    '''
+    Calculates the basis from scratch, see make_basis.
+    '''
+    B0 = orientation_to_basis(orientation)
+    B1 = rotation_to_basis(rotation)
+
+    return matmul3(B0, B1)
+
+
+# Pre-calculated tables. There are only 24 bases (Orientation * Rotation),
+# each one has an integer id, see basis_id.
+
+def basis_id(orientation, rotation):
+    '''
+    :return: an integer in [0, 24), index in BASES and the other tables
+    '''
+    return orientation * len(Rotation) + rotation
+
+def _transpose(M):
+    return tuple(tuple(M[j][i] for j in range(3)) for i in range(3))
+
+def _apply(M, vec):
+    return tuple(M[i][0] * vec[0] + M[i][1] * vec[1] + M[i][2] * vec[2] for i in range(3))
+
+BASES = [None] * (len(Orientation) * len(Rotation))
+for _o in Orientation:
+    for _r in Rotation:
+        BASES[basis_id(_o, _r)] = tuple(tuple(row) for row in calc_basis(_o, _r))
+
+# The bases are orthogonal, so an inverse is a transpose
+INVERSES = [_transpose(B) for B in BASES]
+
+# REL_TO_WORLD[basis id][relative direction] -> direction in the world coordinates
+REL_TO_WORLD = [{o: VECTOR_ORIENTATIONS[_apply(B, v)] for o, v in ORIENTATION_VECTORS.items()}
+                for B in BASES]
+
+# WORLD_TO_REL[basis id][world direction] -> direction relative to the cube
+WORLD_TO_REL = [{w: o for o, w in m.items()} for m in REL_TO_WORLD]
+
+# FACING_WALL[basis id of a cube][basis id of the neighbour][relative direction
+# to the neighbour] -> the wall of the neighbour (relative to the neighbour)
+# that faces the cube
+FACING_WALL = [[{o: w2r[OPPOSING_DIRECTIONS[w]] for o, w in r2w.items()} for w2r in WORLD_TO_REL]
+               for r2w in REL_TO_WORLD]
+
+# (basis_from, basis_to) -> basis_to^-1 * basis_from
+_TRANSFORMS = {(BASES[i], BASES[j]): tuple(tuple(row) for row in matmul3(INVERSES[j], BASES[i]))
+               for i in range(len(BASES)) for j in range(len(BASES))}
+
 def make_basis(orientation, rotation):
     '''
     The 'normal' orientation is heading East rotated Up. So that we
@@ -217,12 +253,9 @@ def make_basis(orientation, rotation):
     :param rotation: member of Rotation
     :return: 3 tuples that represent the affine transition matrix from
             game coordinate system to the cube's coordinate system.
-            (ok, at the moment this is a list, but we need to optimise it)
+            Read from BASES, don't modify it.
     '''
-    B0 = orientation_to_basis(orientation)
-    B1 = rotation_to_basis(rotation)
-
-    return matmul3(B0, B1)
+    return BASES[basis_id(orientation, rotation)]
 
 world_basis = make_basis(Orientation.East, Rotation.Up)
 
@@ -242,24 +275,55 @@ def vec_to_basis(vec, basis_from, basis_to=world_basis, do_round=True):
     if basis_to == basis_from: return vec
 
     # vec~ = basis_to^-1 * basis_from * vec
-    if basis_to == world_basis:
+    if basis_to is world_basis:
         full_transf = basis_from  # small CPU saving
     else:
-        full_transf = matmul3(matinv3(basis_to), basis_from)
-
-    scal = lambda a, b: sum(map(mul, a, b))
+        full_transf = None
+        if isinstance(basis_from, tuple) and isinstance(basis_to, tuple):
+            full_transf = _TRANSFORMS.get((basis_from, basis_to))
+        if full_transf is None:
+            # not one of the 24 bases from make_basis
+            full_transf = matmul3(matinv3(basis_to), basis_from)
 
-    new_vec = [0, 0, 0]
-    for i, row_i in enumerate(full_transf):
-        new_vec[i] = scal(row_i, vec)
-        if do_round:
-            new_vec[i] = round(new_vec[i])
-
-    return new_vec[0], new_vec[1], new_vec[2]
+    new_vec = _apply(full_transf, vec)
+    if do_round:
+        return round(new_vec[0]), round(new_vec[1]), round(new_vec[2])
+    return new_vec
 
 
 if __name__ == "__main__":
 
+    # Consistency of the tables with the math above
+    for o in Orientation:
+        for r in Rotation:
+            i = basis_id(o, r)
+            B = calc_basis(o, r)
+            assert make_basis(o, r) == tuple(tuple(row) for row in B)
+            I = matmul3(INVERSES[i], B)
+            assert I == [[1, 0, 0], [0, 1, 0], [0, 0, 1]], (o, r, I)
+            assert [[round(v) for v in row] for row in matinv3(B)] == [list(row) for row in INVERSES[i]]
+            for d in Orientation:
+                vec = orientation_to_vector(d)
+                gl_vec = tuple(round(sum(B[k][m] * vec[m] for m in range(3))) for k in range(3))
+                assert REL_TO_WORLD[i][d] == vector_to_orientation(gl_vec)
+                assert vec_to_basis(vec, B) == gl_vec
+                assert WORLD_TO_REL[i][REL_TO_WORLD[i][d]] == d
+            for o2 in Orientation:
+                for r2 in Rotation:
+                    j = basis_id(o2, r2)
+                    B2 = calc_basis(o2, r2)
+                    for d in Orientation:
+                        # the way world.connect_cube_to_neighbours did it
+                        point_vec = vec_to_basis(orientation_to_vector(d), B, B2)
+                        slow = matmul3(matinv3(B2), B)
+                        vec = orientation_to_vector(d)
+                        assert point_vec == tuple(round(sum(slow[k][m] * vec[m] for m in range(3))) for k in range(3))
+                        wall = vector_to_orientation((-point_vec[0], -point_vec[1], -point_vec[2]))
+                        assert FACING_WALL[i][j][d] == wall
+    for o in Orientation:
+        assert get_opposing_direction(get_opposing_direction(o)) == o
+    print("All the {} bases are consistent".format(len(BASES)))
+
     # A small test case
     B = make_basis(Orientation.Up, Rotation.Down)
     invB = matinv3(B)
@@ -273,6 +337,3 @@ if __name__ == "__main__":
     rel_direction = [1, 0, 0]
     absolute_dir = vec_to_basis(rel_direction, B)
     print(absolute_dir)
-
-
-
@@ -1,70 +1,378 @@
 
 import logging
+from math import ceil, floor, sqrt, inf
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # no passive block storage and no vectorized connect then
 
 from simcubes.behaviours.basebehaviour import cBehaviourHolder
 from simcubes.en import Orientation
-from simcubes.vec import orientation_to_vector, vector_to_orientation, make_basis, vec_to_basis
+from simcubes.vec import orientation_to_vector, make_basis, vec_to_basis, basis_id, REL_TO_WORLD, FACING_WALL
+from simcubes.vec import ORIENTATION_VECTORS, OPPOSING_DIRECTIONS
 
 logger = logging.getLogger(__name__)
 
 
+# Chunks are cubes of CHUNK_SIZE blocks along each axis, the chunk of
+# a block is defined by it's coordinates.
+CHUNK_BITS = 4
+CHUNK_SIZE = 1 << CHUNK_BITS
+
+# Coordinates are packed into one int: COORD_BITS for each axis,
+# biased, so that negative coordinates work as well.
+COORD_BITS = 21
+COORD_BIAS = 1 << (COORD_BITS - 1)
+COORD_MASK = (1 << COORD_BITS) - 1
+
+
+def pack_coords(x, y, z):
+    '''
+    :return: an int key for (x, y, z), each one in [-COORD_BIAS, COORD_BIAS)
+    '''
+    return ((x + COORD_BIAS) << (2 * COORD_BITS)) | ((y + COORD_BIAS) << COORD_BITS) | (z + COORD_BIAS)
+
+
+def unpack_coords(key):
+    '''
+    :return: (x, y, z), the inverse of pack_coords
+    '''
+    return ((key >> (2 * COORD_BITS)) - COORD_BIAS,
+            ((key >> COORD_BITS) & COORD_MASK) - COORD_BIAS,
+            (key & COORD_MASK) - COORD_BIAS)
+
+
+def _pack_coords_array(xyz):
+    '''
+    pack_coords for a numpy array with (x, y, z) rows
+    '''
+    biased = xyz + COORD_BIAS
+    return (biased[:, 0] << (2 * COORD_BITS)) | (biased[:, 1] << COORD_BITS) | biased[:, 2]
+
+
+def coords_to_chunk_id(x, y, z):
+    '''
+    :return: the chunk id - packed chunk coordinates (see unpack_coords)
+    '''
+    return pack_coords(x >> CHUNK_BITS, y >> CHUNK_BITS, z >> CHUNK_BITS)
+
+
+# cube type -> cSimCube subclass, for the passive blocks (see register_passive_cube)
+_passive_classes = {}
+
+
+def register_passive_cube(cube_type, cube_class):
+    '''
+    Blocks of this type are stored in arrays (see cPassiveChunk) until
+    somebody asks for the block, then cube_class is constructed
+    as cube_class(gid, x, y, z, cube_type, orientation, rotation).
+    :param cube_type: en.CubeTypes
+    :param cube_class: a cSimCube subclass without threads and wall services
+    '''
+    _passive_classes[cube_type] = cube_class
+
+
+class cPassiveChunk:
+    '''
+    Passive blocks of one chunk (bedrock, sand...) in dense arrays indexed
+    by the local coordinates (x, y, z in [0, CHUNK_SIZE)). Type 0 is for
+    no passive block.
+    '''
+
+    def __init__(self):
+        shape = (CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE)
+        self.types = np.zeros(shape, dtype=np.int8)
+        self.orientations = np.zeros(shape, dtype=np.int8)
+        self.rotations = np.zeros(shape, dtype=np.int8)
+        self.gids = np.zeros(shape, dtype=np.int64)
+        self.count = 0
+
+    def put(self, local, cube_type, orientation, rotation, gid):
+        if not self.types[local]:
+            self.count += 1
+        self.types[local] = cube_type
+        self.orientations[local] = orientation
+        self.rotations[local] = rotation
+        self.gids[local] = gid
+
+    def take(self, local):
+        '''
+        Removes the block.
+        :return: (cube_type, orientation, rotation, gid) or None
+        '''
+        cube_type = int(self.types[local])
+        if not cube_type:
+            return None
+        self.types[local] = 0
+        self.count -= 1
+        return cube_type, int(self.orientations[local]), int(self.rotations[local]), int(self.gids[local])
+
+
+def _local_coords(x, y, z):
+    return x & (CHUNK_SIZE - 1), y & (CHUNK_SIZE - 1), z & (CHUNK_SIZE - 1)
+
+
+# (class A, wall A, class B, wall B) -> cSimCube.match_cubewall_services result,
+# only for the cubes with static_walls
+_handshakes = {}
+
+
 class cSimWorld:
     '''
     The whole world. A main class to generate, save, load, interact with simcubes.
     '''
     def __init__(self):
         '''
-        chunks holds links to all the blocks
-        active_chunk - active element from self.chunks
+        chunks holds links to all the blocks: chunk_id -> {gid: block}
+        coords - an index for each chunk: chunk_id -> {packed coords: block}
+        passive - passive blocks: chunk_id -> cPassiveChunk
+        Chunk ids are packed chunk coordinates, see coords_to_chunk_id.
         '''
         self.chunks = {}
-        self.active_chunk_id = None
+        self.coords = {}
+        self.passive = {}
+        self.env = None  # see set_environment
 
-    def set_active_chunk(self, chunk_id):
+    def set_environment(self, env):
         '''
-        Call this every time you switch between chunks
-        :param chunk_id: active chunk id
+        After this call the world is live: add_block connects the new
+        blocks and starts their threads, remove_block stops them.
+        Start the threads of the blocks that are already here yourself.
+        :param env: cSimEnvironment
         '''
-        if not(chunk_id in self.chunks):
-            self.chunks[chunk_id] = {}
-        self.active_chunk_id = chunk_id
+        self.env = env
 
     def add_block(self, new_game_block):
         '''
-        Add block to the active chunk
+        Add block to the world, the chunk is found by the block coordinates.
         :param new_game_block: a new game block, with a generated gid.
         '''
         # TODO: generate gid
-        # TODO: save chunk as a reference
         new_game_block.world = self
-        self.chunks[self.active_chunk_id][new_game_block.gid] = new_game_block
+        self._put_into_chunk(new_game_block)
+        self._link_neighbours(new_game_block)
+        if self.env is not None:
+            # a live world: only the new block and it's neighbours are touched
+            to_merge = [new_game_block]
+            for neigh in new_game_block.neighbours:
+                if neigh is not None:
+                    to_merge += [neigh] + neigh.unmerge()
+            new_game_block.connect()
+            touched = self._get_connected_neighbour_behaviours(new_game_block)
+            self.env.start_threads(new_game_block.iter_behaviours())
+            for beh in touched:
+                if beh.env is not None:
+                    beh.restart()
+            self._merge_connected_blocks(to_merge)
+
+    def add_passive_block(self, cube_type, x, y, z, orientation=0, rotation=0, *, gid):
+        '''
+        Add a block of a passive type (see register_passive_cube). It's kept
+        in the chunk arrays, the cube is constructed only when somebody asks
+        for it (get_cube_at). Without numpy the cube is constructed at once.
+        :param gid: game id of the block, unique like the ones of the other
+                blocks (the constructed cubes are kept by gid in the chunks)
+        '''
+        if np is None:
+            self.add_block(_passive_classes[cube_type](gid, x, y, z, cube_type, orientation, rotation))
+            return
+        chunk_id = coords_to_chunk_id(x, y, z)
+        passive = self.passive.get(chunk_id)
+        if passive is None:
+            passive = self.passive[chunk_id] = cPassiveChunk()
+        passive.put(_local_coords(x, y, z), cube_type, orientation, rotation, gid)
+
+    def get_cube_type_at(self, x, y, z):
+        '''
+        :return: en.CubeTypes of the block at (x, y, z) or None.
+                Doesn't construct the passive blocks.
+        '''
+        cube = self._get_full_cube_at(x, y, z)
+        if cube is not None:
+            return cube.cube_type
+        passive = self.passive.get(coords_to_chunk_id(x, y, z))
+        if passive is not None:
+            cube_type = int(passive.types[_local_coords(x, y, z)])
+            if cube_type:
+                return cube_type
+        return None
+
+    def iter_passive_blocks(self):
+        '''
+        Iterates over the passive blocks that are not constructed.
+        :return: tuples (cube_type, x, y, z, orientation, rotation, gid)
+        '''
+        for chunk_id, passive in self.passive.items():
+            cx, cy, cz = unpack_coords(chunk_id)
+            for lx, ly, lz in zip(*np.nonzero(passive.types)):
+                local = (lx, ly, lz)
+                yield (int(passive.types[local]),
+                       (cx << CHUNK_BITS) + int(lx), (cy << CHUNK_BITS) + int(ly), (cz << CHUNK_BITS) + int(lz),
+                       int(passive.orientations[local]), int(passive.rotations[local]), int(passive.gids[local]))
+
+    def _construct_passive_block(self, x, y, z):
+        '''
+        Takes the passive block from the arrays and adds it as a cube.
+        :return: the cube or None if there is no passive block
+        '''
+        passive = self.passive.get(coords_to_chunk_id(x, y, z))
+        if passive is None:
+            return None
+        taken = passive.take(_local_coords(x, y, z))
+        if taken is None:
+            return None
+        cube_type, orientation, rotation, gid = taken
+        cube = _passive_classes[cube_type](gid, x, y, z, cube_type, orientation, rotation)
+        # The block was in the world all along, it has no threads and no wall
+        # services, so the neighbours are not touched (add_block would unmerge,
+        # connect and restart them in a live world).
+        cube.world = self
+        self._put_into_chunk(cube)
+        self._link_neighbours(cube)
+        return cube
+
+    def remove_block(self, block):
+        '''
+        Remove the block from the world (from the chunk and the neighbour links).
+        The behaviours of the block are disconnected, their threads are
+        stopped. The connected behaviours of the neighbours are restarted.
+        :param block: a block from this world
+        '''
+        to_merge = block.unmerge()
+        touched = self._get_connected_neighbour_behaviours(block)
+        for beh in block.iter_behaviours():
+            if beh.env is not None:
+                beh.env.stop_a_thread(beh)
+            for other in list(beh.connected):
+                if not(other in touched):
+                    touched += [other]
+                beh.disconnect_from(other)
+        for other in touched:
+            for beh in block.iter_behaviours():
+                if beh in other.connected:
+                    other.disconnect_from(beh)
+            if other.env is not None:
+                other.restart()
+        self._unlink_neighbours(block)
+        chunk_id = block.chunk_id
+        key = pack_coords(*block.get_coords())
+        if self.coords[chunk_id].get(key) is block:
+            del self.coords[chunk_id][key]
+        del self.chunks[chunk_id][block.gid]
+        block.world = None
+        # the rest of it's belt (or whatever it was merged into)
+        self._merge_connected_blocks([bl for bl in to_merge if bl.world is self])
+
+    def move_block(self, block, old_coords):
+        '''
+        Update the coordinate index, cSimCube.set_coords calls this.
+        The block may move to another chunk.
+        :param block: a block from this world with new coordinates
+        :param old_coords: (x, y, z) the block had before
+        '''
+        chunk_id = block.chunk_id
+        old_key = pack_coords(*old_coords)
+        if self.coords[chunk_id].get(old_key) is block:
+            del self.coords[chunk_id][old_key]
+        del self.chunks[chunk_id][block.gid]
+        self._unlink_neighbours(block)
+        self._put_into_chunk(block)
+        self._link_neighbours(block)
+        if block.chunk_id != chunk_id:
+            for beh in block.iter_behaviours():
+                if beh.env is not None:
+                    beh.chunk_id = block.chunk_id  # the next events go to the new chunk
+
+    def _put_into_chunk(self, block):
+        x, y, z = block.get_coords()
+        chunk_id = coords_to_chunk_id(x, y, z)
+        if not(chunk_id in self.chunks):
+            self.chunks[chunk_id] = {}
+            self.coords[chunk_id] = {}
+        block.chunk_id = chunk_id
+        self.chunks[chunk_id][block.gid] = block
+        self.coords[chunk_id][pack_coords(x, y, z)] = block
+        passive = self.passive.get(chunk_id)
+        if passive is not None:
+            passive.take(_local_coords(x, y, z))  # the block replaces the passive one
+
+    def _get_connected_neighbour_behaviours(self, block):
+        '''
+        :return: a list of behaviours of the neighbours that are connected
+                to the block behaviours (one way or the other)
+        '''
+        own = list(block.iter_behaviours())
+        connected = []
+        for neigh in block.neighbours:
+            if neigh is None:
+                continue
+            for other in neigh.iter_behaviours():
+                for beh in own:
+                    if (other in beh.connected) or (beh in other.connected):
+                        connected += [other]
+                        break
+        return connected
+
+    def _link_neighbours(self, block):
+        '''
+        Fill block.neighbours and the opposite slots of the neighbours.
+        '''
+        x, y, z = block.get_coords()
+        for direction, vec in ORIENTATION_VECTORS.items():
+            neigh = self._get_full_cube_at(x + vec[0], y + vec[1], z + vec[2])
+            block.neighbours[direction] = neigh
+            if neigh is not None:
+                neigh.neighbours[OPPOSING_DIRECTIONS[direction]] = block
+
+    def _unlink_neighbours(self, block):
+        for direction, neigh in enumerate(block.neighbours):
+            if neigh is not None:
+                opposing = OPPOSING_DIRECTIONS[direction]
+                if neigh.neighbours[opposing] is block:
+                    neigh.neighbours[opposing] = None
+                block.neighbours[direction] = None
+
+    def get_cube_at(self, x, y, z):
+        '''
+        :return: a cube at (x, y, z) or None, in any chunk. A passive
+                block is constructed here.
+        '''
+        cube = self._get_full_cube_at(x, y, z)
+        if cube is None and self.passive:
+            cube = self._construct_passive_block(x, y, z)
+        return cube
+
+    def _get_full_cube_at(self, x, y, z):
+        chunk_coords = self.coords.get(coords_to_chunk_id(x, y, z))
+        if chunk_coords is None:
+            return None
+        return chunk_coords.get(pack_coords(x, y, z))
 
     def get_neighbour_cube_with_offset_direction(self, cube, direction):
         '''
-        Get the neighbour to the cube in the given direction (in the active chunk)
+        Get the neighbour to the cube in the given direction (may be in another chunk)
         :param cube: some cube that's already in the world
         :param direction: find a cube in this direction (member of Orientation)
                 (relative to the cube's direction), 1 step over the axis.
         :return: a cube or None
         '''
+        if cube.world is self:
+            neigh = cube.neighbours[direction]
+            if neigh is not None or not self.passive:
+                return neigh
         dirvec = orientation_to_vector(direction)
         return self.get_cube_with_offset_vector(cube, dirvec)
 
     def get_cube_with_offset_vector(self, cube, dirvec):
         '''
-        Get the neighbour to the cube in the given direction (in the active chunk)
+        Get the neighbour to the cube in the given direction (may be in another chunk)
         This does not account for cube orientation.
         :param cube: offset to this cube's coordinates
         :param dirvec: an offset vector like (1, 0, 0)
         :return: a cube or None
         '''
-        thischunk = self.chunks[self.active_chunk_id]
-        desired_coords = (cube.x + dirvec[0], cube.y + dirvec[1], cube.z + dirvec[2])
-        # FIXME: we need a hashmap with coordinates for an active chunk
-        for cube_i in thischunk.values():
-            if cube_i.get_coords() == desired_coords:
-                return cube_i
-        return None
+        return self.get_cube_at(cube.x + dirvec[0], cube.y + dirvec[1], cube.z + dirvec[2])
 
     def get_neighbour_by_relative_direction(self, cube, direction):
         '''
@@ -74,6 +382,10 @@ class cSimWorld:
         :param direction: find a cube in this direction (member of Orientation)
         :return: a cube or None
         '''
+        if cube.world is self:
+            neigh = cube.get_relative_neighbour(direction)
+            if neigh is not None or not self.passive:
+                return neigh
         dirvec = orientation_to_vector(direction)
         return self.get_neighbour_by_relative_offset_vector(cube, dirvec)
 
@@ -96,9 +408,294 @@ class cSimWorld:
         # print(dirvec, " -> ", gl_vec)
         return self.get_cube_with_offset_vector(cube, gl_vec)
 
+    def connect_all_blocks(self):
+        '''
+        Connects all the blocks in the world, the same as calling connect()
+        of each block (in iter_over_blocks order), but the neighbours are
+        found in one vectorized pass with numpy. Blocks with their own
+        connect() are connected one by one. Falls back to that for all the
+        blocks without numpy.
+        Then the connected blocks are merged, see cSimCube.merge_connected_blocks.
+        '''
+        self._connect_blocks_in_bulk()
+        self._merge_connected_blocks()
+
+    def _merge_connected_blocks(self, blocks=None):
+        '''
+        :param blocks: (optional) merge only these blocks, all by default
+        '''
+        does_merge = {}  # class -> True if it overrides merge_connected_blocks
+        by_class = {}
+        for bl in (self.iter_over_blocks() if blocks is None else blocks):
+            cls = type(bl)
+            merges = does_merge.get(cls)
+            if merges is None:
+                merges = does_merge[cls] = \
+                    cls.merge_connected_blocks.__func__ is not cSimCube.merge_connected_blocks.__func__
+            if merges:
+                if not(cls in by_class):
+                    by_class[cls] = []
+                by_class[cls] += [bl]
+        for cls, blocks in by_class.items():
+            cls.merge_connected_blocks(self, blocks)
+
+    def _connect_blocks_in_bulk(self):
+        if np is None:
+            for bl in self.iter_over_blocks():
+                bl.connect()
+            return
+
+        blocks = []
+        masks = []  # bit rel_dir is set if the block exposes something there
+        directions = tuple(Orientation)
+        class_masks = {}  # for the classes with static_walls
+        for bl in self.iter_over_blocks():
+            cls = type(bl)
+            if cls.connect is not cSimCube.connect:
+                bl.connect()
+                continue
+            if cls.expose_cubewall_provided_service_types is cSimCube.expose_cubewall_provided_service_types and \
+                    cls.expose_cubewall_requested_service_types is cSimCube.expose_cubewall_requested_service_types:
+                continue  # isolated
+            mask = class_masks.get(cls) if cls.static_walls else None
+            if mask is None:
+                mask = 0
+                for rel_dir in directions:
+                    if not bl.is_cubewall_isolated(rel_dir):
+                        mask |= 1 << rel_dir
+                if cls.static_walls:
+                    class_masks[cls] = mask
+            if mask:
+                blocks += [bl]
+                masks += [mask]
+        if not blocks:
+            return
+
+        all_blocks = list(self.iter_over_blocks())  # neighbours may be any blocks
+        n_all = len(all_blocks)
+        xyz = np.fromiter((c for bl in all_blocks for c in bl.get_coords()), dtype=np.int64, count=3 * n_all)
+        xyz = xyz.reshape((n_all, 3))
+        bids = np.fromiter((basis_id(bl.orientation, bl.rotation) for bl in all_blocks), dtype=np.int64, count=n_all)
+        keys = _pack_coords_array(xyz)
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        position = {id(bl): i for i, bl in enumerate(all_blocks)}
+        idx = np.fromiter((position[id(bl)] for bl in blocks), dtype=np.int64, count=len(blocks))
+        masks = np.array(masks, dtype=np.int64)
+
+        dir_vectors = np.array([orientation_to_vector(o) for o in Orientation], dtype=np.int64)
+        rel_to_world = np.array([[m[o] for o in Orientation] for m in REL_TO_WORLD], dtype=np.int64)
+        facing_wall = np.array([[[m[o] for o in Orientation] for m in row] for row in FACING_WALL], dtype=np.int64)
+
+        pairs = []  # (block number, rel_dir, neighbour index, wall_direction) arrays
+        for rel_dir in Orientation:
+            sel = np.nonzero(masks & (1 << rel_dir))[0]
+            if not len(sel):
+                continue
+            this = idx[sel]
+            offsets = dir_vectors[rel_to_world[bids[this], rel_dir]]
+            target = _pack_coords_array(xyz[this] + offsets)
+            pos = np.minimum(np.searchsorted(sorted_keys, target), n_all - 1)
+            found = sorted_keys[pos] == target
+            neigh = order[pos[found]]
+            walls = facing_wall[bids[this[found]], bids[neigh], rel_dir]
+            pairs += [(sel[found], np.full(len(neigh), int(rel_dir)), neigh, walls)]
+        if not pairs:
+            return
+
+        num, rel_dirs, neighs, walls = (np.concatenate(arr) for arr in zip(*pairs))
+        shake_order = np.lexsort((rel_dirs, num)).tolist()
+        num, rel_dirs, neighs, walls = num.tolist(), rel_dirs.tolist(), neighs.tolist(), walls.tolist()
+        log_info = logger.isEnabledFor(logging.INFO)  # the debug strings are expensive
+        for k in shake_order:
+            bl = blocks[num[k]]
+            neigh_block = all_blocks[neighs[k]]
+            rel_dir = directions[rel_dirs[k]]
+            if log_info:
+                logger.info(neigh_block.get_debug_string() + " IS " + str(rel_dir) + " REL TO " + bl.get_debug_string())
+            bl.shake_hands_with_cube(neigh_block, rel_dir, directions[walls[k]])
+
+    # Spatial queries. The chunk grid is the index: only the chunks that
+    # intersect the region are looked at.
+
+    def iter_cubes_in_box(self, x0, y0, z0, x1, y1, z1, cube_types=None, include_passive=False):
+        '''
+        :param x0, y0, z0, x1, y1, z1: corners of the box, inclusive
+        :param cube_types: (optional) a collection of en.CubeTypes
+        :param include_passive: construct and return the passive blocks as well
+        :return: iterator over the cubes in the box
+        '''
+        box = (min(x0, x1), min(y0, y1), min(z0, z1), max(x0, x1), max(y0, y1), max(z0, z1))
+        return self._iter_cubes_in_region(box, None, None, cube_types, include_passive)
+
+    def iter_cubes_in_sphere(self, x, y, z, radius, cube_types=None, include_passive=False):
+        '''
+        :param x, y, z: the centre (may be float)
+        :param radius: cubes with the centres not further than this are returned
+        :param cube_types: (optional) a collection of en.CubeTypes
+        :param include_passive: construct and return the passive blocks as well
+        :return: iterator over the cubes in the sphere
+        '''
+        box = (ceil(x - radius), ceil(y - radius), ceil(z - radius),
+               floor(x + radius), floor(y + radius), floor(z + radius))
+        r2 = radius * radius
+
+        def is_inside(bx, by, bz):
+            return (bx - x) ** 2 + (by - y) ** 2 + (bz - z) ** 2 <= r2
+
+        def is_chunk_near(cx, cy, cz):
+            # distance from the centre to the chunk bounding box
+            d2 = 0
+            for c, v in ((cx, x), (cy, y), (cz, z)):
+                lo = c << CHUNK_BITS
+                hi = lo + CHUNK_SIZE - 1
+                if v < lo:
+                    d2 += (lo - v) ** 2
+                elif v > hi:
+                    d2 += (v - hi) ** 2
+            return d2 <= r2
+
+        return self._iter_cubes_in_region(box, is_inside, is_chunk_near, cube_types, include_passive)
+
+    def iter_cubes_on_ray(self, origin, direction, max_distance, cube_types=None, include_passive=False):
+        '''
+        Walks the cells along the ray (a cube at (x, y, z) takes the cell
+        [x - 0.5, x + 0.5] on each axis), only the chunks on the way are
+        looked at.
+        :param origin: (x, y, z), may be float
+        :param direction: (dx, dy, dz), not zero
+        :param max_distance: the length of the ray, may be inf: the walk
+                ends where the ray leaves the chunks of the world anyway
+        :param cube_types: (optional) a collection of en.CubeTypes
+        :param include_passive: construct and return the passive blocks as well
+        :return: iterator over the cubes in the order the ray meets them
+        '''
+        length = sqrt(sum(d * d for d in direction))
+        if length == 0:
+            raise ValueError('Zero ray direction')
+        start = [o + 0.5 for o in origin]
+        cell = [floor(o) for o in start]
+        step = [0, 0, 0]
+        t_max = [inf, inf, inf]
+        t_delta = [inf, inf, inf]
+        for i in range(3):
+            d = direction[i] / length
+            if d > 0:
+                step[i] = 1
+                t_max[i] = (cell[i] + 1 - start[i]) / d
+                t_delta[i] = 1 / d
+            elif d < 0:
+                step[i] = -1
+                t_max[i] = (cell[i] - start[i]) / d
+                t_delta[i] = -1 / d
+        max_distance = min(max_distance, self._get_ray_exit(start, direction, length))
+        if cube_types is not None:
+            cube_types = set(cube_types)
+        t = 0
+        while t <= max_distance:
+            cube = self._get_full_cube_at(*cell)
+            if cube is None and include_passive and self.passive:
+                cube_type = self.get_cube_type_at(*cell)
+                if cube_type is not None and (cube_types is None or cube_type in cube_types):
+                    cube = self._construct_passive_block(*cell)
+            if cube is not None and (cube_types is None or cube.cube_type in cube_types):
+                yield cube
+            axis = t_max.index(min(t_max))
+            t = t_max[axis]
+            cell[axis] += step[axis]
+            t_max[axis] += t_delta[axis]
+
+    def _get_ray_exit(self, start, direction, length):
+        '''
+        :param start: the ray origin in the cell coordinates (see iter_cubes_on_ray)
+        :return: distance along the ray to the point where it leaves the
+                bounding box of the existing chunks, negative if it never
+                gets there
+        '''
+        chunk_coords = [unpack_coords(chunk_id) for chunk_id in set(self.chunks) | set(self.passive)]
+        if not chunk_coords:
+            return -1
+        t_exit = inf
+        for i in range(3):
+            lo = min(c[i] for c in chunk_coords) << CHUNK_BITS
+            hi = (max(c[i] for c in chunk_coords) + 1) << CHUNK_BITS
+            d = direction[i] / length
+            if d > 0:
+                t_exit = min(t_exit, (hi - start[i]) / d)
+            elif d < 0:
+                t_exit = min(t_exit, (lo - start[i]) / d)
+            elif not(lo <= start[i] < hi):
+                return -1
+        return t_exit
+
+    def _iter_chunks_in_box(self, box):
+        '''
+        :return: iterator over (chunk_id, (cx, cy, cz)) of the existing chunks
+                that intersect the box
+        '''
+        cx0, cy0, cz0 = box[0] >> CHUNK_BITS, box[1] >> CHUNK_BITS, box[2] >> CHUNK_BITS
+        cx1, cy1, cz1 = box[3] >> CHUNK_BITS, box[4] >> CHUNK_BITS, box[5] >> CHUNK_BITS
+        n_cells = (cx1 - cx0 + 1) * (cy1 - cy0 + 1) * (cz1 - cz0 + 1)
+        if n_cells > len(self.chunks) + len(self.passive):
+            # a huge box, cheaper to look at the existing chunks
+            for chunk_id in set(self.chunks) | set(self.passive):
+                cx, cy, cz = unpack_coords(chunk_id)
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1 and cz0 <= cz <= cz1:
+                    yield chunk_id, (cx, cy, cz)
+            return
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for cz in range(cz0, cz1 + 1):
+                    chunk_id = pack_coords(cx, cy, cz)
+                    if chunk_id in self.chunks or chunk_id in self.passive:
+                        yield chunk_id, (cx, cy, cz)
+
+    def _iter_cubes_in_region(self, box, is_inside, is_chunk_near, cube_types, include_passive):
+        '''
+        :param box: (x0, y0, z0, x1, y1, z1) the bounding box, inclusive
+        :param is_inside: (optional) a function (x, y, z) -> bool, for the cubes in the box
+        :param is_chunk_near: (optional) a function (cx, cy, cz) -> bool, the chunks
+                for which it's False are skipped
+        '''
+        if cube_types is not None:
+            cube_types = set(cube_types)
+        x0, y0, z0, x1, y1, z1 = box
+        for chunk_id, chunk_coords in list(self._iter_chunks_in_box(box)):
+            if is_chunk_near is not None and not is_chunk_near(*chunk_coords):
+                continue
+            found = []
+            for cube in self.chunks.get(chunk_id, {}).values():
+                if cube_types is not None and not(cube.cube_type in cube_types):
+                    continue
+                if x0 <= cube.x <= x1 and y0 <= cube.y <= y1 and z0 <= cube.z <= z1 and \
+                        (is_inside is None or is_inside(cube.x, cube.y, cube.z)):
+                    found += [cube]
+            if include_passive and chunk_id in self.passive:
+                for coords in self._find_passive_in_box(chunk_id, chunk_coords, box, cube_types):
+                    if is_inside is None or is_inside(*coords):
+                        found += [self._construct_passive_block(*coords)]
+            for cube in found:
+                yield cube
+
+    def _find_passive_in_box(self, chunk_id, chunk_coords, box, cube_types):
+        '''
+        :return: a list of (x, y, z) of the passive blocks of the chunk in the box
+        '''
+        base = [c << CHUNK_BITS for c in chunk_coords]
+        lo = [max(box[i] - base[i], 0) for i in range(3)]
+        hi = [min(box[i + 3] - base[i], CHUNK_SIZE - 1) + 1 for i in range(3)]
+        types = self.passive[chunk_id].types[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        if cube_types is None:
+            mask = types != 0
+        else:
+            mask = np.isin(types, list(cube_types))
+        return [(base[0] + lo[0] + int(lx), base[1] + lo[1] + int(ly), base[2] + lo[2] + int(lz))
+                for lx, ly, lz in zip(*np.nonzero(mask))]
+
     def iter_over_blocks(self):
         '''
-        Iterates over all the blocks in the world (debug purposes)
+        Iterates over all the blocks in the world (debug purposes),
+        except the passive ones (see iter_passive_blocks)
         '''
         for ch_i in self.chunks.values():
             for bl_i in ch_i.values():
@@ -110,7 +707,7 @@ class cSimWorld:
         '''
         s = "A sim world with blocks: \n"
         for i, chunk_i in self.chunks.items():
-            s += "\n*** CHUNK num" + str(i) + ":\n"
+            s += "\n*** CHUNK " + str(unpack_coords(i)) + ":\n"
             for bl in chunk_i.values():
                 s += "\t" + bl.get_debug_string() + "\n"
         return s
@@ -122,6 +719,11 @@ class cSimCube(cBehaviourHolder):
     block - this makes it easy to update it.
     This thing is inherented by concrete realisations.
     '''
+    # Set to True if the exposed wall services depend only on the class and
+    # the wall (not on the cube state). Then they are asked once per class,
+    # see get_cubewall_services and shake_hands_with_cube.
+    static_walls = False
+
     def __init__(self, gid=0, x=0, y=0, z=0, cube_type=0, orientation = 0, rotation = 0):
         '''
         :param gid: game id of the block, same as in the game
@@ -138,6 +740,10 @@ class cSimCube(cBehaviourHolder):
         self.orientation = orientation
         self.rotation = rotation  # 0 for "Up", heading to the sky
         self.world = None
+        self.chunk_id = None  # set by cSimWorld.add_block
+        # adjacent cubes by world direction (en.Orientation), kept by cSimWorld.
+        # Passive blocks that are not constructed yet are not here.
+        self.neighbours = [None] * len(ORIENTATION_VECTORS)
         self.init_behaviours()
 
     def init_behaviours(self):
@@ -157,6 +763,26 @@ class cSimCube(cBehaviourHolder):
         '''
         self.connect_cube_to_neighbours()
 
+    @classmethod
+    def merge_connected_blocks(cls, world, blocks):
+        '''
+        Called by cSimWorld.connect_all_blocks when all the blocks are
+        connected, with all the blocks of this class. Override to merge
+        the behaviours of connected blocks into one (see cConveyor), the
+        threads are not started yet.
+        '''
+        pass
+
+    def unmerge(self):
+        '''
+        Undo merge_connected_blocks for this block, called by cSimWorld before
+        a live change next to it (connections of this block may change).
+        After the change cSimWorld merges the returned blocks again.
+        :return: a list of the blocks this one was merged with (including
+                itself), empty if it wasn't merged
+        '''
+        return []
+
     def get_debug_string(self):
         return "Block of type " + str(self.cube_type) + " num" + str(self.gid) + " at " + str(self.x) + \
                "," + str(self.y) + "," + str(self.z) + " o:" + str(self.orientation) + " r:" + str(self.rotation)
@@ -171,21 +797,39 @@ class cSimCube(cBehaviourHolder):
         return self.x, self.y, self.z
 
     def set_coords(self, x, y, z):
+        old_coords = self.get_coords()
         self.x = x
         self.y = y
         self.z = z
+        if self.world is not None:
+            self.world.move_block(self, old_coords)
+
+    def get_neighbour(self, direction):
+        '''
+        :param direction: en.Orientation in the world coordinates
+        :return: an adjacent cube or None
+        '''
+        return self.neighbours[direction]
+
+    def get_relative_neighbour(self, rel_orientation):
+        '''
+        :param rel_orientation: en.Orientation relative to the cube
+                orientation and rotation (Front is East)
+        :return: an adjacent cube or None
+        '''
+        return self.neighbours[REL_TO_WORLD[basis_id(self.orientation, self.rotation)][rel_orientation]]
 
     def set_orientation(self, orientation):
         self.orientation = orientation
 
     def set_x(self, x):
-        self.x = x
+        self.set_coords(x, self.y, self.z)
 
     def set_y(self, y):
-        self.y = y
+        self.set_coords(self.x, y, self.z)
 
     def set_z(self, z):
-        self.z = z
+        self.set_coords(self.x, self.y, z)
 
     # Cube wall-to-wall connectivity
 
@@ -227,6 +871,37 @@ class cSimCube(cBehaviourHolder):
         '''
         return None
 
+    def get_cubewall_services(self, rel_orientation):
+        '''
+        Asks expose_cubewall_provided_service_types and
+        expose_cubewall_requested_service_types, once per class if static_walls.
+        :param rel_orientation: en.Orientation, relative to the block orientation.
+        :return: a tuple (provided, requested), each one is a tuple of
+                en.ServiceTypes or None.
+        '''
+        cls = type(self)
+        if cls.static_walls:
+            cache = cls.__dict__.get('_wall_services')  # own dict for each class
+            if cache is None:
+                cache = cls._wall_services = {}
+            services = cache.get(rel_orientation)
+            if services is None:
+                services = cache[rel_orientation] = self._ask_cubewall_services(rel_orientation)
+            return services
+        return self._ask_cubewall_services(rel_orientation)
+
+    def _ask_cubewall_services(self, rel_orientation):
+        provided = self.expose_cubewall_provided_service_types(rel_orientation)
+        requested = self.expose_cubewall_requested_service_types(rel_orientation)
+        return (None if provided is None else tuple(provided),
+                None if requested is None else tuple(requested))
+
+    def is_cubewall_isolated(self, rel_orientation):
+        '''
+        :return: True if there are no services on the wall, no need to shake hands
+        '''
+        return self.get_cubewall_services(rel_orientation) == (None, None)
+
     def connect_cube_to_neighbours(self):
         '''
         Default connectivity call. Asks expose_cubewall_provided_service_types
@@ -234,30 +909,22 @@ class cSimCube(cBehaviourHolder):
         each wall provide / request and call cBehaviourHolder.behavioural_connect_to
         if request=provide in the meeting directions.
         '''
-        Z0 = make_basis(self.orientation, self.rotation)
+        bid = basis_id(self.orientation, self.rotation)
+        rel_to_world = REL_TO_WORLD[bid]
         for rel_dir in Orientation:  # it works, don't listen to PyCharm
             # A small optimisation - no need to shake hands if we are isolated
-            if (self.expose_cubewall_provided_service_types(rel_dir) is None) and \
-                (self.expose_cubewall_requested_service_types(rel_dir) is None):
+            if self.is_cubewall_isolated(rel_dir):
                 continue
 
-            # Find a neighbour
-            # absolute_offset - offset in world coordinates in rel_dir relative to
-            #                   this cube orientation and rotation.
-            absolute_offset = vec_to_basis(orientation_to_vector(rel_dir), Z0)
-
-            neigh_block = self.world.get_cube_with_offset_vector(self, absolute_offset)
+            # Find a neighbour in rel_dir relative to this cube orientation and rotation.
+            neigh_block = self.neighbours[rel_to_world[rel_dir]]
             if neigh_block is None:
                 continue
             logger.info(neigh_block.get_debug_string() + " IS " + str(rel_dir) + " REL TO " + self.get_debug_string())
 
             # Now we need to understand which wall is nearby - pointing to which direction?
-            # Construct the basis for the other cube
-            Z1 = make_basis(neigh_block.orientation, neigh_block.rotation)
-            # Our rel_dir is pointing to point_vec in the other block coordinates
-            point_vec = vec_to_basis(orientation_to_vector(rel_dir), Z0, Z1)
-            # To find the wall that is directed on us, we need an inverse
-            wall_direction = vector_to_orientation( (-point_vec[0], -point_vec[1], -point_vec[2]) )
+            # (in the other cube coordinates, see vec.FACING_WALL)
+            wall_direction = FACING_WALL[bid][basis_id(neigh_block.orientation, neigh_block.rotation)][rel_dir]
 
             # Now we can shake hands over the cube walls. See the docstring in shake_hands_with_cube.
             self.shake_hands_with_cube(neigh_block, rel_dir, wall_direction)
@@ -265,44 +932,57 @@ class cSimCube(cBehaviourHolder):
     def shake_hands_with_cube(self, other, selfdir, otherdir):
         '''
         Call expose_cubewall_provided_service_types and expose_cubewall_requested_service_types
-        to check whether they need each other.
+        to check whether they need each other. If both cubes have static_walls,
+        the match is looked up in a table (by the classes and the walls).
         :param other: another cube
         :param selfdir: when looking from this cube coordinate system (defined with orientation and rotation),
                         in which direction do we see the other cube? (East is front, North is left e.t.c.)
         :param otherdir: when looking from the other cube coordinate system, in which direction do we see
                         this cube?
         '''
-        logger.info(self.get_debug_string() + " MEET " + other.get_debug_string() + " WALL {0} TO {1} ".format(str(selfdir), str(otherdir)))
-
-        i_provide = self.expose_cubewall_provided_service_types(selfdir)
-        he_needs = other.expose_cubewall_requested_service_types(otherdir)
-        i_need = self.expose_cubewall_requested_service_types(selfdir)
-        he_provide = other.expose_cubewall_provided_service_types(otherdir)
-
+        log_info = logger.isEnabledFor(logging.INFO)  # the debug strings are expensive
+        if log_info:
+            logger.info(self.get_debug_string() + " MEET " + other.get_debug_string() + " WALL {0} TO {1} ".format(str(selfdir), str(otherdir)))
+
+        if self.static_walls and other.static_walls:
+            key = (type(self), selfdir, type(other), otherdir)
+            matches = _handshakes.get(key)
+            if matches is None:
+                matches = _handshakes[key] = self.match_cubewall_services(other, selfdir, otherdir)
+        else:
+            matches = self.match_cubewall_services(other, selfdir, otherdir)
+
+        i_need_from_him, i_offer_to_him = matches
+        for this_ser, other_ser in i_need_from_him:
+            if log_info:
+                logger.info(self.get_debug_string() + ' NEEDS ' + str(this_ser) + ' FROM ' + other.get_debug_string())
+            # the provider connects to the client
+            other.connect_to_another_holder(self, other_ser, this_ser)
+        for this_ser, other_ser in i_offer_to_him:
+            if log_info:
+                logger.info(self.get_debug_string() + ' OFFERS ' + str(this_ser) + ' TO ' + other.get_debug_string())
+            self.connect_to_another_holder(other, this_ser, other_ser)
+
+    def match_cubewall_services(self, other, selfdir, otherdir):
+        '''
+        See shake_hands_with_cube.
+        :return: a tuple of two lists with (this cube service, other cube service)
+                pairs: what this cube needs from the other one and what it
+                offers to the other one.
+        '''
+        i_provide, i_need = self.get_cubewall_services(selfdir)
+        he_provide, he_needs = other.get_cubewall_services(otherdir)
+
+        i_need_from_him = []
         if not((i_need is None) or (he_provide is None)):
             for this_ser in i_need:
                 for other_ser in he_provide:
                     if this_ser == other_ser:
-                        logger.info(self.get_debug_string() + ' NEEDS ' + str(this_ser) + ' FROM ' + other.get_debug_string())
-                        self.connect_to_another_holder(other, this_ser, other_ser)
+                        i_need_from_him += [(this_ser, other_ser)]
+        i_offer_to_him = []
         if not((i_provide is None) or (he_needs is None)):
             for this_ser in i_provide:
                 for other_ser in he_needs:
                     if this_ser == other_ser:
-                        logger.info(self.get_debug_string() + ' OFFERS ' + str(this_ser) + ' TO ' + other.get_debug_string())
-                        self.connect_to_another_holder(other, this_ser, other_ser)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+                        i_offer_to_him += [(this_ser, other_ser)]
+        return i_need_from_him, i_offer_to_him